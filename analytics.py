@@ -0,0 +1,86 @@
+from calendar import monthrange
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Statistics shown by /budget and /dashboard. The transactions are held as columns (day as an int, amount
+# in the base currency, category as an int code) and every statistic is computed over whole columns:
+# with NumPy as array operations, without it by the plain Python loops below.
+TREND_WINDOW = 3
+
+
+def to_columns(transactions):
+    # transactions: (date, amount, category) tuples
+    category_codes = dict()
+    days, amounts, categories = list(), list(), list()
+    for day, amount, category in transactions:
+        days.append(day.toordinal())
+        amounts.append(amount)
+        categories.append(category_codes.setdefault(category, len(category_codes)))
+    if np is not None:
+        days = np.array(days, dtype=np.int64)
+        amounts = np.array(amounts, dtype=np.float64)
+        categories = np.array(categories, dtype=np.int64)
+    return {"days": days, "amounts": amounts, "categories": categories, "category_names": list(category_codes)}
+
+
+def days_counted(months, today):
+    # the current month only counts the days gone by
+    return [today.day if (year, month) == (today.year, today.month) else monthrange(year, month)[1]
+            for year, month in months]
+
+
+def analyze(months, totals, budget, today, columns, window=TREND_WINDOW):
+    # months: (year, month) pairs in order with their expense totals; columns: the transactions to break
+    # down by category. The trend is the average of the last `window` calendar months, empty ones included.
+    if not months:
+        return {"average_daily": list(), "remaining": list(), "trend": list(),
+                "categories": category_totals(columns)}
+    if np is None:
+        return _analyze_python(months, totals, budget, today, columns, window)
+    totals = np.asarray(totals, dtype=np.float64)
+    average_daily = totals / np.asarray(days_counted(months, today), dtype=np.float64)
+    remaining = budget - totals
+    positions = np.array([year * 12 + month - 1 for year, month in months], dtype=np.int64)
+    positions -= positions[0]
+    calendar_totals = np.zeros(positions[-1] + 1, dtype=np.float64)
+    calendar_totals[positions] = totals
+    cumulative = np.concatenate(([0.0], np.cumsum(calendar_totals)))
+    ends = positions + 1
+    starts = np.maximum(ends - window, 0)
+    trend = (cumulative[ends] - cumulative[starts]) / (ends - starts)
+    return {"average_daily": average_daily.tolist(), "remaining": remaining.tolist(), "trend": trend.tolist(),
+            "categories": category_totals(columns)}
+
+
+def _analyze_python(months, totals, budget, today, columns, window):
+    average_daily = [total / days for total, days in zip(totals, days_counted(months, today))]
+    remaining = [budget - total for total in totals]
+    by_position = {year * 12 + month - 1: total for (year, month), total in zip(months, totals)}
+    trend = list()
+    for year, month in months:
+        position = year * 12 + month - 1
+        window_months = [by_position.get(previous, 0) for previous in range(position - window + 1, position + 1)
+                         if previous >= months[0][0] * 12 + months[0][1] - 1]
+        trend.append(sum(window_months) / len(window_months))
+    return {"average_daily": average_daily, "remaining": remaining, "trend": trend,
+            "categories": category_totals(columns)}
+
+
+def spent_since(columns, day):
+    if np is not None:
+        return float(columns["amounts"][columns["days"] >= day.toordinal()].sum())
+    return sum(amount for ordinal, amount in zip(columns["days"], columns["amounts"]) if ordinal >= day.toordinal())
+
+
+def category_totals(columns):
+    names = columns["category_names"]
+    if np is not None:
+        sums = np.bincount(columns["categories"], weights=columns["amounts"], minlength=len(names)).tolist()
+    else:
+        sums = [0.0] * len(names)
+        for category, amount in zip(columns["categories"], columns["amounts"]):
+            sums[category] += amount
+    return dict(sorted(zip(names, sums), key=lambda item: item[1], reverse=True))
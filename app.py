@@ -1,25 +1,64 @@
-from flask import Flask, render_template, redirect, url_for, flash, request
+from flask import Flask, render_template, redirect, url_for, flash, request, abort, stream_template, \
+    stream_with_context, g, Blueprint, before_render_template, template_rendered, has_request_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import StringField, PasswordField, SubmitField, SelectField, DateField
 from wtforms.validators import InputRequired, Length, ValidationError, Optional
-from flask_bcrypt import Bcrypt
-import json
 import os
-from datetime import datetime
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+import passwords
+import metrics
+from storage import read_from_file, file_lock, read_generation, stamp_generation
+from statements import read_csv_rows, read_ofx_rows
+from rates import refresh_rates, base_currency, to_base
+from analytics import to_columns, analyze, spent_since
+from settlements import to_minor, from_minor, split_shares, settle
+from datetime import datetime, date, timedelta
+import cProfile
+import csv
+import gzip
+import hashlib
+import io
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+from functools import cached_property
 from calendar import monthrange
 
 app = Flask(__name__)
 
-bcrypt = Bcrypt(app)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+# only SQLite is supported: the connection pragmas and timeout below and the upserts of the monthly totals and
+# plans are SQLite's, so DATABASE_URL can move the file but not change the database
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///database.db")
+if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+    raise RuntimeError(f"DATABASE_URL must be an sqlite:/// URL, not a "
+                       f"{make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()} one")
 app.config["SECRET_KEY"] = "thisisasecretkey"
+# wait for a busy database instead of failing when several worker processes write at once
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {"connect_args": {"timeout": 30}}
+# bcrypt cost (each step doubles the time of a login) and how many hashes may be computed at once
+app.config["BCRYPT_LOG_ROUNDS"] = int(os.environ.get("BCRYPT_LOG_ROUNDS", passwords.DEFAULT_ROUNDS))
+app.config["PASSWORD_HASH_WORKERS"] = int(os.environ.get("PASSWORD_HASH_WORKERS", passwords.DEFAULT_WORKERS))
+passwords.configure(app.config["BCRYPT_LOG_ROUNDS"], app.config["PASSWORD_HASH_WORKERS"])
+# METRICS_ENABLED=1 times requests, templates and hot functions for /metrics; PROFILE_SLOW_REQUESTS_MS saves a
+# cProfile dump of every request slower than that to PROFILE_DIR
+app.config["METRICS_ENABLED"] = os.environ.get("METRICS_ENABLED", "") == "1"
+app.config["PROFILE_SLOW_REQUESTS_MS"] = int(os.environ.get("PROFILE_SLOW_REQUESTS_MS", 0))
+app.config["PROFILE_DIR"] = os.environ.get("PROFILE_DIR", os.path.join(app.instance_path, "profiles"))
+metrics.configure(app.config["METRICS_ENABLED"])
 db = SQLAlchemy(app)
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# JSON files used before the data was moved to the database, read only by the import-json command
 EXPENSES_FILE = "expenses.json"
 CATEGORIES_FILE = "categories.json"
 BUDGET_FILE = "budget.json"
@@ -28,26 +67,26 @@ INCOME_FILE = "income.json"
 
 possible_currency = ["¥", "€", "£", "$"]
 
+# ISO codes of imported statements; "¥" is the yuan, whose rates exchange_rates.json lists, so JPY rows are
+# rejected as an unknown currency rather than counted as yuan
+CURRENCY_CODES = {"CNY": "¥", "EUR": "€", "GBP": "£", "USD": "$"}
 
-# Functions to read/write from/to JSON files
-def write_to_file(filepath, data):
-    with open(filepath, "w") as file:
-        json.dump(data, file)
-
-
-def read_from_file(filepath):
-    if os.path.exists(filepath):
-        with open(filepath, "r") as file:
-            return json.load(file)
-    return dict()
-
+PAGE_SIZE = 50
+STREAM_BATCH_SIZE = 500
+IMPORT_BATCH_SIZE = 1000
+PROJECTION_MONTHS = 12
+MAX_IMPORT_ERRORS = 100
+API_GZIP_MIN_BYTES = 1024
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 60
+USER_GENERATION_FILE = os.path.join(app.instance_path, "users.generation")
 
-# define the data readen from the files
-expenses = read_from_file(EXPENSES_FILE)
-categories = read_from_file(CATEGORIES_FILE)
-budgets = read_from_file(BUDGET_FILE)
-shared_expenses = read_from_file(SHARED_EXPENSES_FILE)
-income = read_from_file(INCOME_FILE)
+_user_cache = OrderedDict()
+_user_cache_lock = threading.Lock()
+_user_cache_generation = None
+# since Python 3.12 cProfile runs on sys.monitoring, which takes one profiler per interpreter: a request that
+# finds another one being profiled is not profiled
+_profiler_lock = threading.Lock()
 
 
 class User(db.Model, UserMixin):
@@ -56,6 +95,167 @@ class User(db.Model, UserMixin):
     password = db.Column(db.String(80), nullable=False)
 
 
+class Expense(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    description = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    # (user_id, category, date) also serves category-only filters and keeps category + date range queries
+    # a single index range scan, already sorted by date. AUTOINCREMENT keeps SQLite from handing out the id
+    # of a deleted expense again, so ids in links and page cursors never change meaning
+    __table_args__ = (db.Index("ix_expense_user_date", "user_id", "date"),
+                      db.Index("ix_expense_user_category_date", "user_id", "category", "date"),
+                      {"sqlite_autoincrement": True})
+
+
+class Income(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    description = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    __table_args__ = (db.Index("ix_income_user_date", "user_id", "date"),)
+
+
+class Budget(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    amount = db.Column(db.Float, nullable=False)
+
+
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    name = db.Column(db.String(20), nullable=False)
+    __table_args__ = (db.Index("ix_category_user_name", "user_id", "name"),)
+
+
+class SharedGroup(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=False)
+
+
+# a member of a shared group
+class SharedFriend(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    group_id = db.Column(db.Integer, db.ForeignKey("shared_group.id"))
+    name = db.Column(db.String(100), nullable=False)
+    # running totals in minor units of the base currency: what the friend paid and their share of it all
+    paid = db.Column(db.Integer, nullable=False, default=0)
+    owed = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index("ix_shared_friend_group_name", "group_id", "name"),)
+
+
+class SharedExpense(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    group_id = db.Column(db.Integer, db.ForeignKey("shared_group.id"))
+    amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    paid_by = db.Column(db.String(100), nullable=False)
+    date = db.Column(db.Date, nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    # JSON {friend: weight} of how the amount is divided
+    split = db.Column(db.Text)
+    __table_args__ = (db.Index("ix_shared_expense_user_date", "user_id", "date"),
+                      db.Index("ix_shared_expense_user_category", "user_id", "category"),
+                      db.Index("ix_shared_expense_group_date", "group_id", "date"))
+
+
+# running total of each user's expenses per month, kept up to date by add/delete and rebuilt when missing
+class MonthlyTotal(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    total = db.Column(db.Float, nullable=False, default=0)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+
+# a monthly expense or income (rent, salary) on the day of the month of its first date. Occurrences up to today
+# are saved as transactions from next_date on; those from next_date to planned_until are counted in MonthlyPlan
+class RecurringRule(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    currency = db.Column(db.String(3), nullable=False)
+    description = db.Column(db.String(100), nullable=False)
+    category = db.Column(db.String(20))
+    day = db.Column(db.Integer, nullable=False)
+    end_date = db.Column(db.Date)
+    next_date = db.Column(db.Date)
+    planned_until = db.Column(db.Date, nullable=False)
+    __table_args__ = (db.Index("ix_recurring_rule_user_next", "user_id", "next_date"),)
+
+
+class CategoryBudget(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    category = db.Column(db.String(20), primary_key=True)
+    amount = db.Column(db.Float, nullable=False)
+
+
+# what the recurring rules will still add to the months of the forecast: one row per rule and month, in the base
+# currency at the rate of the day it was planned, deleted as it is when the occurrence is saved or the rule removed,
+# so a rate published in between leaves nothing behind. Category is "" for income
+class MonthlyPlan(db.Model):
+    rule_id = db.Column(db.Integer, db.ForeignKey("recurring_rule.id"), primary_key=True)
+    year = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    category = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Float, nullable=False)
+    __table_args__ = (db.Index("ix_monthly_plan_user_month", "user_id", "year", "month"),)
+
+
+EXPORT_FIELDS = {
+    "expenses": (Expense, ["id", "date", "amount", "currency", "description", "category"]),
+    "income": (Income, ["id", "date", "amount", "currency", "description"]),
+    "shared": (SharedExpense, ["id", "group_id", "date", "amount", "currency", "paid_by", "category"]),
+}
+
+
+with app.app_context():
+    @db.event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(connection, connection_record):
+        # write-ahead logging lets readers in other workers go on while one worker writes
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    # every SQL statement, for /metrics: the database is where the requests do their I/O
+    @db.event.listens_for(db.engine, "before_cursor_execute")
+    def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+        if metrics.enabled():
+            connection.info["query_start"] = time.perf_counter()
+
+    @db.event.listens_for(db.engine, "after_cursor_execute")
+    def record_query_time(connection, cursor, statement, parameters, context, executemany):
+        start = connection.info.pop("query_start", None)
+        if start is not None:
+            metrics.observe("db_query_duration_seconds", time.perf_counter() - start,
+                            operation=statement.split(None, 1)[0].upper(),
+                            endpoint=(request.endpoint or "none") if has_request_context() else "none")
+
+    db.create_all()
+
+
+def number(form, field):
+    # amounts are typed in text fields: anything float() rejects is an error, and so are nan and inf
+    try:
+        value = float(field.data)
+    except (TypeError, ValueError):
+        raise ValidationError("Not a valid number")
+    if not math.isfinite(value):
+        raise ValidationError("Not a valid number")
+
+
 class RegisterForm(FlaskForm):
     username = StringField(validators=[InputRequired(), Length(min=4, max=20)], render_kw={"placeholder": "Username"})
     password = PasswordField(validators=[InputRequired(), Length(min=8, max=20)], render_kw={"placeholder": "Password"})
@@ -79,7 +279,7 @@ class CategoryForm(FlaskForm):
 
 
 class ExpenseForm(FlaskForm):
-    amount = StringField(validators=[InputRequired()], render_kw={"placeholder": "Amount"})
+    amount = StringField(validators=[InputRequired(), number], render_kw={"placeholder": "Amount"})
     description = StringField(validators=[InputRequired(), Length(min=1, max=100)],
                               render_kw={"placeholder": "Description"})
     currency = SelectField("Currency", choices=list(), validators=[InputRequired()],
@@ -90,7 +290,7 @@ class ExpenseForm(FlaskForm):
 
 
 class BudgetForm(FlaskForm):
-    budget = StringField(validators=[InputRequired()], render_kw={"placeholder": "Budget"})
+    budget = StringField(validators=[InputRequired(), number], render_kw={"placeholder": "Budget"})
     submit = SubmitField("Set budget")
     
     
@@ -101,33 +301,258 @@ class FilterForm(FlaskForm):
     submit = SubmitField("Filter")
     
     
+class SharedGroupForm(FlaskForm):
+    group_name = StringField("Group", validators=[InputRequired(), Length(min=1, max=100)],
+                             render_kw={"placeholder": "Group name"})
+    submit = SubmitField("Create group")
+
+
 class SharedExpensesFriendForm(FlaskForm):
     friends = StringField("Friend", validators=[InputRequired()], render_kw={"placeholder": "Friend"})
     submit = SubmitField("Add friend")
 
 
 class SharedExpenseForm(FlaskForm):
-    amount = StringField(validators=[InputRequired()], render_kw={"placeholder": "Amount"})
+    amount = StringField(validators=[InputRequired(), number], render_kw={"placeholder": "Amount"})
     currency = SelectField("Currency", choices=list(), validators=[InputRequired()], render_kw={"placeholder": "Currency"})
     date = DateField("Date", format="%Y-%m-%d", validators=[InputRequired()])
     category = SelectField("category", choices=list(), validators=[InputRequired()])
     paid_by = SelectField("Paid by", choices=list(), validators=[InputRequired()], render_kw={"placeholder": "Paid by"})
+    split = StringField("Split", validators=[Optional()], render_kw={"placeholder": "Even, or e.g. Anna:2, Bob:1"})
     submit = SubmitField("Add expense")
     
     
 class IncomeForm(FlaskForm):
-    amount = StringField(validators=[InputRequired()], render_kw={"placeholder": "Amount"})
+    amount = StringField(validators=[InputRequired(), number], render_kw={"placeholder": "Amount"})
     description = StringField(validators=[InputRequired(), Length(min=1, max=100)],
                               render_kw={"placeholder": "Description"})
     currency = SelectField("Currency", choices=list(), validators=[InputRequired()],
                            render_kw={"placeholder": "Currency"})
     date = DateField("Date", format="%Y-%m-%d", validators=[InputRequired()])
     submit = SubmitField("Add income")
+
+
+class CategoryBudgetForm(FlaskForm):
+    budget_category = SelectField("Category", choices=list(), validators=[InputRequired()])
+    category_budget = StringField(validators=[InputRequired(), number],
+                                  render_kw={"placeholder": "Budget of the category"})
+    submit = SubmitField("Set category budget")
+
+
+class RecurringRuleForm(FlaskForm):
+    kind = SelectField("Kind", choices=[("expenses", "Expense"), ("income", "Income")], validators=[InputRequired()])
+    amount = StringField(validators=[InputRequired(), number], render_kw={"placeholder": "Amount"})
+    description = StringField(validators=[InputRequired(), Length(min=1, max=100)],
+                              render_kw={"placeholder": "Description"})
+    currency = SelectField("Currency", choices=list(), validators=[InputRequired()])
+    category = SelectField("Category (expenses)", choices=list(), validators=[Optional()])
+    start_date = DateField("First date", format="%Y-%m-%d", validators=[InputRequired()])
+    end_date = DateField("Last date", format="%Y-%m-%d", validators=[Optional()])
+    submit = SubmitField("Add recurring transaction")
+
+
+class ImportForm(FlaskForm):
+    file = FileField("Statement (CSV or OFX)", validators=[FileRequired()])
+    kind = SelectField("Import CSV rows as", choices=[("expenses", "Expenses"), ("income", "Income")],
+                       validators=[InputRequired()])
+    category = SelectField("Category for rows without one", choices=list(), validators=[Optional()])
+    submit = SubmitField("Import")
     
     
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # users are kept for USER_CACHE_TTL seconds; any change to a user, in this process or another one,
+    # bumps the generation file and empties the cache
+    global _user_cache_generation
+    user_id = int(user_id)
+    generation = read_generation(USER_GENERATION_FILE)
+    with _user_cache_lock:
+        if generation != _user_cache_generation:
+            _user_cache.clear()
+            _user_cache_generation = generation
+        cached = _user_cache.get(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            _user_cache.move_to_end(user_id)
+            return cached[1]
+    user = db.session.get(User, user_id)
+    if user is not None:
+        # detached so that it outlives the request's session
+        db.session.expunge(user)
+        with _user_cache_lock:
+            _user_cache[user_id] = (time.monotonic() + USER_CACHE_TTL, user)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > USER_CACHE_SIZE:
+                _user_cache.popitem(last=False)
+    return user
+
+
+@db.event.listens_for(User, "after_insert")
+@db.event.listens_for(User, "after_update")
+@db.event.listens_for(User, "after_delete")
+def forget_user(mapper, connection, user):
+    with _user_cache_lock:
+        _user_cache.pop(user.id, None)
+    stamp_generation(USER_GENERATION_FILE)
+
+
+class UserContext:
+    # what the pages need about one user, each part fetched at most once per request
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    @cached_property
+    def categories(self):
+        return [category.name for category in Category.query.filter_by(user_id=self.user_id).order_by(Category.id)]
+
+    @cached_property
+    def budget(self):
+        budget = db.session.get(Budget, self.user_id)
+        return budget.amount if budget else 0
+
+    @cached_property
+    def monthly_totals(self):
+        return load_monthly_totals(self.user_id)
+
+    def forget(self, *names):
+        # for the routes that change what was already fetched during the request
+        for name in names:
+            self.__dict__.pop(name, None)
+
+    def expenses(self, category=None, start_date=None, end_date=None):
+        return filter_expenses(self.user_id, category, start_date, end_date)
+
+
+def user_context(user_id=None):
+    # g lives as long as the request, so every route and helper shares the same context
+    user_id = current_user.id if user_id is None else user_id
+    contexts = g.setdefault("user_contexts", dict())
+    if user_id not in contexts:
+        contexts[user_id] = UserContext(user_id)
+    return contexts[user_id]
+
+
+def user_categories(user_id):
+    return user_context(user_id).categories
+
+
+def user_budget_amount(user_id):
+    return user_context(user_id).budget
+
+
+def month_bounds(day):
+    return day.replace(day=1), day.replace(day=monthrange(day.year, day.month)[1])
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def paginate(query, model, after):
+    # keyset pagination on (date, id): every page is an index range scan, however far back the user goes
+    if after:
+        try:
+            after_date, after_id = after.split("_")
+            query = query.filter(db.tuple_(model.date, model.id) > (parse_date(after_date), int(after_id)))
+        except ValueError:
+            abort(400)
+    rows = query.limit(PAGE_SIZE + 1).all()
+    next_cursor = None
+    if len(rows) > PAGE_SIZE:
+        rows = rows[:PAGE_SIZE]
+        next_cursor = f"{rows[-1].date.strftime('%Y-%m-%d')}_{rows[-1].id}"
+    return rows, next_cursor
+
+
+def render_list(template, rows_name, query, model, filters=None, **context):
+    # ?stream=1 renders the whole history while rows are fetched in batches, otherwise one page at a time
+    filters = filters or dict()
+    if request.args.get("stream"):
+        context[rows_name] = query.yield_per(STREAM_BATCH_SIZE)
+        return app.response_class(stream_template(template, next_url=None, filters=filters, **context))
+    context[rows_name], next_cursor = paginate(query, model, request.args.get("after"))
+    next_url = None
+    if next_cursor:
+        next_url = url_for(request.endpoint, after=next_cursor, **filters)
+    return render_template(template, next_url=next_url, filters=filters, **context)
+
+
+@app.before_request
+def start_request_timer():
+    if not metrics.enabled() and not app.config["PROFILE_SLOW_REQUESTS_MS"]:
+        return
+    g.request_start = time.perf_counter()
+    if app.config["PROFILE_SLOW_REQUESTS_MS"] and _profiler_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def stop_profiler():
+    profiler = g.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+    return profiler
+
+
+@app.after_request
+def record_request_time(response):
+    # streamed responses are only timed until their first byte
+    if "request_start" not in g:
+        return response
+    profiler = stop_profiler()
+    elapsed = time.perf_counter() - g.pop("request_start")
+    metrics.observe("request_duration_seconds", elapsed, endpoint=request.endpoint or "none", method=request.method,
+                    status=response.status_code)
+    if profiler is not None and elapsed * 1000 >= app.config["PROFILE_SLOW_REQUESTS_MS"]:
+        os.makedirs(app.config["PROFILE_DIR"], exist_ok=True)
+        name = f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{request.endpoint or 'none'}-{elapsed * 1000:.0f}ms.prof"
+        profiler.dump_stats(os.path.join(app.config["PROFILE_DIR"], name))
+    return response
+
+
+@app.teardown_request
+def stop_request_timer(error):
+    # after_request is skipped when the view raised
+    stop_profiler()
+    if "request_start" in g:
+        metrics.observe("request_duration_seconds", time.perf_counter() - g.pop("request_start"),
+                        endpoint=request.endpoint or "none", method=request.method, status=500)
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    if metrics.enabled():
+        g.setdefault("template_starts", list()).append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def record_template_time(sender, template, context, **extra):
+    if metrics.enabled() and g.get("template_starts"):
+        metrics.observe("template_duration_seconds", time.perf_counter() - g.template_starts.pop(),
+                        template=template.name)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    if not metrics.enabled():
+        abort(404)
+    return app.response_class(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.before_request
+def load_exchange_rates():
+    refresh_rates()
+
+
+@app.before_request
+def save_recurring_transactions():
+    if request.endpoint != "static" and current_user.is_authenticated:
+        refresh_recurring(current_user.id, date.today())
+
+
+@app.context_processor
+def inject_base_currency():
+    return {"base_currency": base_currency()}
 
 
 @app.route("/")
@@ -140,7 +565,7 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and passwords.check_password(user.password, form.password.data):
             login_user(user)
             return redirect(url_for("dashboard"))
     return render_template("login.html", form=form)
@@ -149,38 +574,27 @@ def login():
 @app.route("/dashboard", methods=["GET", "POST"])
 @login_required
 def dashboard():
-    user_id = str(current_user.id)
-    monthly_expenses, remaining_budget, average_expense_remaining_days = calculate_monthly_expenses(user_id)
-    current_month = f"{datetime.now().month}-{datetime.now().year}"
-    current_month_income = datetime.now().strftime("%Y-%m")
-    if current_month in remaining_budget.keys():
-        remaining_budget = remaining_budget[current_month]
-        monthly_expenses = monthly_expenses[current_month]
-    elif user_id in budgets.keys():
-        remaining_budget = budgets[user_id]
-        monthly_expenses = 0
-    else:
-        remaining_budget = 0
-        monthly_expenses = monthly_expenses[current_month]
+    user_id = current_user.id
     today = datetime.now()
-    last_day_of_month = monthrange(today.year, today.month)[1]
-    days_remaining = last_day_of_month - today.day + 1
-    average_expense_remaining_days = remaining_budget / days_remaining
-    if user_id in income.keys():
-        user_income = sum([float(inc["amount"]) for inc in income.get(user_id, list())
-                           if inc["date"].startswith(current_month_income)])
-    else:
-        user_income = 0
-    user_expenses = sum([float(exp["amount"]) for exp in expenses.get(user_id, list())
-                         if exp["date"].startswith(current_month)])
-    if user_id in budgets.keys():
-        user_budget = budgets.get(user_id, 0)
+    statistics = user_statistics(user_id, today.date())
+    current_month = f"{datetime.now().month}-{datetime.now().year}"
+    user_budget = statistics["budget"]
+    if current_month in statistics["remaining_budget"].keys():
+        remaining_budget = statistics["remaining_budget"][current_month]
+        monthly_expenses = statistics["monthly_expenses"][current_month]
     else:
-        user_budget = 0
+        remaining_budget = user_budget
+        monthly_expenses = 0
+    this_month = user_forecast(user_id, today.date())[current_month]
+    average_expense_remaining_days = daily_allowance(user_id, today.date(), statistics)
+    user_income = this_month["income"]
+    user_expenses = monthly_expenses
     return render_template("dashboard.html", user_income=user_income, user_expenses=user_expenses,
                            user_budget=user_budget, monthly_expenses=monthly_expenses,
                            remaining_budget=remaining_budget,
-                           average_expense_remaining_days=average_expense_remaining_days)
+                           average_expense_remaining_days=average_expense_remaining_days,
+                           category_expenses=statistics["categories"], last_week=statistics["last_week"],
+                           trend=statistics["trend"].get(current_month, 0), this_month=this_month)
 
 
 @app.route("/logout", methods=["GET", "POST"])
@@ -194,7 +608,7 @@ def logout():
 def register():
     form = RegisterForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data)
+        hashed_password = passwords.hash_password(form.password.data)
         new_user = User(username=form.username.data, password=hashed_password)
         db.session.add(new_user)
         db.session.commit()
@@ -202,26 +616,41 @@ def register():
     return render_template("register.html", form=form)
 
 
+def add_new_category(form_category):
+    new_category = form_category.name.data
+    new_user_category(current_user.id, new_category)
+    flash(f"Category '{new_category}' added successfully!")
+
+
+def new_user_category(user_id, name):
+    db.session.add(Category(user_id=user_id, name=name))
+    db.session.commit()
+    user_context(user_id).forget("categories")
+
+
+def remove_user_category(user_id, name):
+    Category.query.filter_by(user_id=user_id, name=name).delete()
+    db.session.commit()
+    user_context(user_id).forget("categories")
+
+
+def delete_category(category_to_delete, existing_categories):
+    if category_to_delete in existing_categories:
+        remove_user_category(current_user.id, category_to_delete)
+        existing_categories.remove(category_to_delete)
+        flash(f"Category {category_to_delete} has been deleted successfully")
+
+
 @app.route("/add_category", methods=["GET", "POST"])
 @login_required
 def add_category():
     form_category = CategoryForm()
-    existing_categories = categories.get(str(current_user.id), list())
+    existing_categories = user_categories(current_user.id)
     if form_category.validate_on_submit():
-        new_category = form_category.name.data
-        if str(current_user.id) not in categories:
-            categories[str(current_user.id)] = list()
-        categories[str(current_user.id)].append(new_category)
-        write_to_file(CATEGORIES_FILE, categories)
-        flash(f"Category '{new_category}' added successfully!")
+        add_new_category(form_category)
         return redirect(url_for("add_expense"))
     if request.method == "POST" and "delete" in request.form:
-        category_to_delete = request.form.get("delete")
-        if category_to_delete in existing_categories:
-            existing_categories.remove(category_to_delete)
-            categories[str(current_user.id)] = existing_categories
-            write_to_file(CATEGORIES_FILE, categories)
-            flash(f"Category {category_to_delete} has been deleted successfully")
+        delete_category(request.form.get("delete"), existing_categories)
     return redirect(url_for("add_expense"))
 
 
@@ -229,70 +658,118 @@ def add_category():
 @login_required
 def add_expense():
     form_category = CategoryForm()
-    existing_categories = categories.get(str(current_user.id), list())
+    existing_categories = user_categories(current_user.id)
     form = ExpenseForm()
     form.currency.choices = [(curr, curr) for curr in possible_currency]
-    form.category.choices = [(cat, cat) for cat in categories.get(str(current_user.id), list())]
+    form.category.choices = [(cat, cat) for cat in existing_categories]
     if form_category.validate_on_submit():
-        new_category = form_category.name.data
-        if str(current_user.id) not in categories:
-            categories[str(current_user.id)] = list()
-        categories[str(current_user.id)].append(new_category)
-        write_to_file(CATEGORIES_FILE, categories)
-        flash(f"Category '{new_category}' added successfully!")
+        add_new_category(form_category)
         return redirect(url_for("add_category"))
     
     if request.method == "POST" and "delete" in request.form:
-        category_to_delete = request.form.get("delete")
-        if category_to_delete in existing_categories:
-            existing_categories.remove(category_to_delete)
-            categories[str(current_user.id)] = existing_categories
-            write_to_file(CATEGORIES_FILE, categories)
-            flash(f"Category {category_to_delete} has been deleted successfully")
+        delete_category(request.form.get("delete"), existing_categories)
         return render_template("add_expense.html", form=form, form_cat=form_category, categories=existing_categories)
     
     if form.validate_on_submit():
-        if str(current_user.id) not in expenses:
-            expenses[str(current_user.id)] = list()
-        expense_data = {
-            "id": len(expenses[str(current_user.id)]) + 1,
-            "amount": form.amount.data,
-            "currency": form.currency.data,
-            "description": form.description.data,
-            "date": form.date.data.strftime("%Y-%m-%d"),
-            "category": form.category.data
-        }
-        expenses[str(current_user.id)].append(expense_data)
-        write_to_file(EXPENSES_FILE, expenses)
+        new_expense(current_user.id, form)
         return redirect(url_for("dashboard"))
     return render_template("add_expense.html", form=form, form_cat=form_category, categories=existing_categories)
 
 
+def new_expense(user_id, form):
+    expense = Expense(user_id=user_id, amount=float(form.amount.data), currency=form.currency.data,
+                      description=form.description.data, date=form.date.data, category=form.category.data)
+    db.session.add(expense)
+    update_monthly_total(user_id, expense.date, to_base(expense.amount, expense.currency, expense.date), 1)
+    db.session.commit()
+    return expense
+
+
+def save_expense(expense, form):
+    # the form was validated by ExpenseForm, amount included
+    update_monthly_total(expense.user_id, expense.date, -to_base(expense.amount, expense.currency, expense.date), -1)
+    expense.amount = float(form.amount.data)
+    expense.currency = form.currency.data
+    expense.description = form.description.data
+    expense.date = form.date.data
+    expense.category = form.category.data
+    update_monthly_total(expense.user_id, expense.date, to_base(expense.amount, expense.currency, expense.date), 1)
+    db.session.commit()
+
+
+def remove_expense(expense):
+    db.session.delete(expense)
+    update_monthly_total(expense.user_id, expense.date, -to_base(expense.amount, expense.currency, expense.date), -1)
+    db.session.commit()
+
+
+def expense_categories(expense):
+    # an expense keeps its category even after the category was deleted
+    existing_categories = list(user_categories(expense.user_id))
+    if expense.category not in existing_categories:
+        existing_categories.append(expense.category)
+    return existing_categories
+
+
+def user_expense(expense_id):
+    # primary key lookup, answered from the session's identity map when the expense is already loaded
+    expense = db.session.get(Expense, expense_id) if expense_id is not None else None
+    if expense is None or expense.user_id != current_user.id:
+        return None
+    return expense
+
+
+@app.route("/expenses/<int:expense_id>/edit", methods=["GET", "POST"])
+@login_required
+def edit_expense(expense_id):
+    expense = user_expense(expense_id)
+    if expense is None:
+        abort(404)
+    form = ExpenseForm(obj=expense)
+    form.currency.choices = [(curr, curr) for curr in possible_currency]
+    form.category.choices = [(cat, cat) for cat in expense_categories(expense)]
+    form.submit.label.text = "Save expense"
+    if form.validate_on_submit():
+        save_expense(expense, form)
+        flash("The expense has been updated successfully")
+        return redirect(url_for("expenses_view"))
+    return render_template("edit_expense.html", form=form, expense=expense)
+
+
+def filter_transactions(model, user_id, category=None, start_date=None, end_date=None):
+    # every combination is answered by a range scan of one of the (user_id, ...) indexes, ordered by date
+    query = model.query.filter(model.user_id == user_id)
+    if category and category != "None" and hasattr(model, "category"):
+        query = query.filter(model.category == category)
+    if start_date:
+        query = query.filter(model.date >= start_date)
+    if end_date:
+        query = query.filter(model.date <= end_date)
+    return query.order_by(model.date, model.id)
+
+
+def filter_expenses(user_id, category=None, start_date=None, end_date=None):
+    return filter_transactions(Expense, user_id, category, start_date, end_date)
+
+
 @app.route("/expenses", methods=["GET", "POST"])
 @login_required
 def expenses_view():
-    form = FilterForm()
-    form.category.choices = [("None", "None")] + [(cat, cat) for cat in categories.get(str(current_user.id), list())]
-    user_expenses = expenses.get(str(current_user.id), list())
-    if form.validate_on_submit():
-        filer_category = form.category.data
-        filter_start_date = form.start_date.data
-        filter_end_date = form.end_date.data
-        if filer_category and filer_category != "None":
-            user_expenses = [expense for expense in user_expenses if expense["category"] == filer_category]
-        if filter_start_date:
-            user_expenses = [expense for expense in user_expenses
-                             if datetime.strptime(expense["date"], "%Y-%m-%d").date() >= filter_start_date]
-        if filter_end_date:
-            user_expenses = [expense for expense in user_expenses
-                             if datetime.strptime(expense["date"], "%Y-%m-%d").date() <= filter_end_date]
+    # the filters of the following pages come back in the query string
+    form = FilterForm() if request.method == "POST" else FilterForm(formdata=request.args)
+    form.category.choices = [("None", "None")] + [(cat, cat) for cat in user_categories(current_user.id)]
     if request.method == "POST" and "delete" in request.form:
-        expense_id_to_delete = int(request.form.get("delete"))
-        user_expenses = [expense for expense in user_expenses if expense[id] != expense_id_to_delete]
-        expenses[str(current_user.id)] = user_expenses
-        write_to_file(EXPENSES_FILE, user_expenses)
-        flash(f"The expense has been deleted successfully")
-    return render_template("expenses.html", form=form, expenses=user_expenses)
+        expense = user_expense(request.form.get("delete", type=int))
+        if expense:
+            remove_expense(expense)
+            flash(f"The expense has been deleted successfully")
+    filters = dict()
+    if request.method == "GET" or form.validate_on_submit():
+        filters = {name: value for name, value in form.data.items()
+                   if name in ("category", "start_date", "end_date") and value and value != "None"}
+    query = user_context().expenses(**filters)
+    filters = {name: str(value) for name, value in filters.items()}
+    return render_list("expenses.html", "expenses", query, Expense, filters=filters, form=form)
 
 
 @app.route("/income", methods=["GET", "POST"])
@@ -301,173 +778,1013 @@ def income_manager():
     form = IncomeForm()
     form.currency.choices = [(curr, curr) for curr in possible_currency]
     if form.validate_on_submit():
-        if str(current_user.id) not in income:
-            income[str(current_user.id)] = list()
-        income_data = {
-            "amount": form.amount.data,
-            "currency": form.currency.data,
-            "description": form.description.data,
-            "date": form.date.data.strftime("%Y-%m-%d")
-        }
-        income[str(current_user.id)].append(income_data)
-        write_to_file(INCOME_FILE, income)
+        new_income(current_user.id, form)
         return redirect(url_for("dashboard"))
     else:
-        print(form.errors)
-        user_income = income.get(str(current_user.id), list())
-        return render_template("income.html", form=form, income=user_income)
+        if form.errors:
+            app.logger.info("Invalid income form: %s", form.errors)
+        user_income = Income.query.filter_by(user_id=current_user.id).order_by(Income.date, Income.id)
+        return render_list("income.html", "income", user_income, Income, form=form)
+
+
+def new_income(user_id, form):
+    income = Income(user_id=user_id, amount=float(form.amount.data), currency=form.currency.data,
+                    description=form.description.data, date=form.date.data)
+    db.session.add(income)
+    db.session.commit()
+    return income
+
+
+def parse_import_row(row, kind, default_category, existing_categories):
+    if kind not in ("expenses", "income"):
+        raise ValueError(f"unknown kind '{kind}', expected expenses or income")
+    if row.get(None):
+        raise ValueError(f"more fields than the header ({len(row[None])} extra)")
+    try:
+        amount = abs(float(row.get("amount", "")))
+    except ValueError:
+        raise ValueError(f"invalid amount '{row.get('amount', '')}'")
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount '{row.get('amount', '')}'")
+    try:
+        day = parse_date(row.get("date", ""))
+    except ValueError:
+        raise ValueError(f"invalid date '{row.get('date', '')}', expected YYYY-MM-DD")
+    currency = CURRENCY_CODES.get(row.get("currency", "").upper(), row.get("currency", ""))
+    if currency not in possible_currency:
+        raise ValueError(f"unknown currency '{row.get('currency', '')}'")
+    record = {"amount": amount, "currency": currency, "date": day,
+              "description": row.get("description", "")[:100] or "Imported transaction"}
+    if kind == "expenses":
+        category = row.get("category") or default_category
+        if category not in existing_categories:
+            raise ValueError(f"unknown category '{category}'")
+        record["category"] = category
+    return record
+
+
+def import_rows(user_id, rows, default_kind, default_category, existing_categories):
+    # valid rows are inserted in batches of IMPORT_BATCH_SIZE, all of them committed in one transaction
+    start = time.perf_counter()
+    models = {"expenses": Expense, "income": Income}
+    batches = {"expenses": list(), "income": list()}
+    imported = {"expenses": 0, "income": 0}
+    monthly_changes = dict()
+    errors = list()
+    error_count = 0
+    for line_number, row in rows:
+        kind = row.get("kind") or default_kind
+        try:
+            record = parse_import_row(row, kind, default_category, existing_categories)
+        except ValueError as error:
+            error_count += 1
+            if len(errors) < MAX_IMPORT_ERRORS:
+                errors.append((line_number, str(error)))
+            continue
+        record["user_id"] = user_id
+        batches[kind].append(record)
+        if kind == "expenses":
+            month = (record["date"].year, record["date"].month)
+            amount, count = monthly_changes.get(month, (0, 0))
+            monthly_changes[month] = (amount + to_base(record["amount"], record["currency"], record["date"]), count + 1)
+        if len(batches[kind]) >= IMPORT_BATCH_SIZE:
+            db.session.execute(db.insert(models[kind]), batches[kind])
+            imported[kind] += len(batches[kind])
+            batches[kind] = list()
+    for kind, batch in batches.items():
+        if batch:
+            db.session.execute(db.insert(models[kind]), batch)
+            imported[kind] += len(batch)
+    for (year, month), (amount, count) in monthly_changes.items():
+        update_monthly_total(user_id, date(year, month, 1), amount, count)
+    db.session.commit()
+    elapsed = time.perf_counter() - start
+    total_rows = imported["expenses"] + imported["income"] + error_count
+    return {"imported": imported, "errors": errors, "error_count": error_count, "seconds": elapsed,
+            "rows_per_second": total_rows / elapsed if elapsed > 0 else 0}
+
+
+@app.route("/import", methods=["GET", "POST"])
+@login_required
+def import_transactions():
+    form = ImportForm()
+    existing_categories = user_categories(current_user.id)
+    form.category.choices = [("", "None")] + [(cat, cat) for cat in existing_categories]
+    report = None
+    if form.validate_on_submit():
+        upload = form.file.data
+        stream = io.TextIOWrapper(upload.stream, encoding="utf-8-sig", newline="")
+        if upload.filename.lower().endswith((".ofx", ".qfx")):
+            rows = read_ofx_rows(stream)
+        else:
+            rows = read_csv_rows(stream)
+        try:
+            report = import_rows(current_user.id, rows, form.kind.data, form.category.data, existing_categories)
+        except UnicodeDecodeError:
+            # the rows inserted before the undecodable line are not kept
+            db.session.rollback()
+            form.file.errors.append("The file is not UTF-8 text")
+        except csv.Error as error:
+            # a line the csv module cannot read at all, such as a field over its size limit
+            db.session.rollback()
+            form.file.errors.append(f"The file is not a readable CSV statement: {error}")
+    return render_template("import.html", form=form, report=report)
 
 
 @app.route("/budget", methods=["GET", "POST"])
 @login_required
 def manage_budget():
     form = BudgetForm()
+    form_category = CategoryBudgetForm()
+    form_category.budget_category.choices = [(cat, cat) for cat in user_categories(current_user.id)]
     if form.validate_on_submit():
         new_budget = float(request.form.get("budget"))
-        budgets[str(current_user.id)] = new_budget
-        write_to_file(BUDGET_FILE, budgets)
+        set_budget(current_user.id, new_budget)
         flash(f"Budget set to {new_budget}")
         return redirect(url_for("manage_budget"))
-    else:
-        user_budget = budgets.get(str(current_user.id), 0)
-        monthly_expenses, remaining_budget, average_expense_remaining_days = \
-            calculate_monthly_expenses(str(current_user.id))
-        current_date = f"{datetime.now().month}-{datetime.now().year}"
-        average_daily_expense = dict()
-        for date, expense in monthly_expenses.items():
-            month, year = map(int, date.split("-"))
-            if date != current_date:
-                days_in_month = monthrange(year, month)[1]
-            else:
-                days_in_month = datetime.now().day
-            average_daily_expense[date] = expense / days_in_month
-        return render_template("budget.html", form=form, user_budget=user_budget, monthly_expenses=monthly_expenses,
-                               remaining_budget=remaining_budget, expense_remaining_days=average_expense_remaining_days,
-                               current_month=current_date, average_daily_expense=average_daily_expense)
+    if form_category.validate_on_submit():
+        db.session.merge(CategoryBudget(user_id=current_user.id, category=form_category.budget_category.data,
+                                        amount=float(form_category.category_budget.data)))
+        db.session.commit()
+        return redirect(url_for("manage_budget"))
+    if request.method == "POST" and "delete" in request.form:
+        CategoryBudget.query.filter_by(user_id=current_user.id, category=request.form.get("delete")).delete()
+        db.session.commit()
+        return redirect(url_for("manage_budget"))
+    statistics = user_statistics(current_user.id, datetime.now().date())
+    current_date = f"{datetime.now().month}-{datetime.now().year}"
+    today = datetime.now()
+    average_expense_remaining_days = daily_allowance(current_user.id, today.date(), statistics)
+    return render_template("budget.html", form=form, form_category=form_category, user_budget=statistics["budget"],
+                           monthly_expenses=statistics["monthly_expenses"],
+                           remaining_budget=statistics["remaining_budget"],
+                           expense_remaining_days=average_expense_remaining_days, current_month=current_date,
+                           average_daily_expense=statistics["average_daily_expense"], trend=statistics["trend"],
+                           category_expenses=statistics["categories"],
+                           category_budgets=category_budgets(current_user.id, today.date(), statistics["categories"]))
+
+
+@app.route("/forecast", methods=["GET", "POST"])
+@login_required
+def forecast_view():
+    form = RecurringRuleForm()
+    form.currency.choices = [(curr, curr) for curr in possible_currency]
+    form.category.choices = [(cat, cat) for cat in user_categories(current_user.id)]
+    today = date.today()
+    if form.validate_on_submit():
+        if form.kind.data == "expenses" and not form.category.data:
+            form.category.errors.append("A recurring expense needs a category")
+        else:
+            new_recurring_rule(current_user.id, form, today)
+            flash(f"Recurring {form.description.data} added successfully")
+            return redirect(url_for("forecast_view"))
+    if request.method == "POST" and "delete" in request.form:
+        rule = RecurringRule.query.filter_by(id=request.form.get("delete", type=int), user_id=current_user.id).first()
+        if rule:
+            remove_recurring_rule(rule)
+            flash(f"Recurring {rule.description} deleted successfully")
+        return redirect(url_for("forecast_view"))
+    rules = RecurringRule.query.filter_by(user_id=current_user.id).order_by(RecurringRule.day, RecurringRule.id)
+    return render_template("forecast.html", form=form, rules=rules, forecast=user_forecast(current_user.id, today))
     
     
-def calculate_monthly_expenses(user_id):
-    monthly_expenses = dict()
-    user_expenses = expenses.get(user_id, list())
-    if user_id in budgets.keys():
-        user_budget = budgets.get(str(user_id), 0)
+def set_budget(user_id, amount):
+    db.session.merge(Budget(user_id=user_id, amount=amount))
+    db.session.commit()
+    user_context(user_id).forget("budget")
+
+
+def sum_in_base_currency(rows):
+    # rows are (currency, date, amount) sums grouped by the database, so there is one conversion per group
+    return sum(to_base(amount, currency, day) for currency, day, amount in rows)
+
+
+def rebuild_monthly_totals(user_id):
+    # upserted rather than deleted and inserted again, so two requests rebuilding the same user at the same time
+    # both write the same rows instead of one of them failing on the unique index
+    totals = db.session.query(Expense.currency, Expense.date, db.func.sum(Expense.amount), db.func.count(Expense.id))\
+        .filter(Expense.user_id == user_id).group_by(Expense.currency, Expense.date)
+    monthly_totals = dict()
+    for currency, day, total, count in totals:
+        monthly_total = monthly_totals.setdefault((day.year, day.month), [0, 0])
+        monthly_total[0] += to_base(total, currency, day)
+        monthly_total[1] += count
+    if monthly_totals:
+        statement = sqlite_insert(MonthlyTotal).values([
+            {"user_id": user_id, "year": year, "month": month, "total": total, "count": count}
+            for (year, month), (total, count) in monthly_totals.items()])
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=["user_id", "year", "month"],
+            set_={"total": statement.excluded.total, "count": statement.excluded.count}))
+    MonthlyTotal.query.filter(MonthlyTotal.user_id == user_id,
+                              db.tuple_(MonthlyTotal.year, MonthlyTotal.month).notin_(list(monthly_totals)))\
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def user_monthly_totals(user_id):
+    return user_context(user_id).monthly_totals
+
+
+def load_monthly_totals(user_id):
+    monthly_totals = MonthlyTotal.query.filter_by(user_id=user_id).order_by(MonthlyTotal.year, MonthlyTotal.month)\
+        .all()
+    if not monthly_totals and Expense.query.filter_by(user_id=user_id).first() is not None:
+        rebuild_monthly_totals(user_id)
+        monthly_totals = MonthlyTotal.query.filter_by(user_id=user_id)\
+            .order_by(MonthlyTotal.year, MonthlyTotal.month).all()
+    return monthly_totals
+
+
+def update_monthly_total(user_id, day, amount, count):
+    # the expense change must already be in the session: while the user has no totals at all they are
+    # rebuilt from the expenses on the next read, which then includes it
+    if MonthlyTotal.query.filter_by(user_id=user_id).first() is None:
+        return
+    statement = sqlite_insert(MonthlyTotal).values(user_id=user_id, year=day.year, month=day.month, total=amount,
+                                                   count=count)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=["user_id", "year", "month"],
+        set_={"total": MonthlyTotal.total + amount, "count": MonthlyTotal.count + count}))
+    MonthlyTotal.query.filter(MonthlyTotal.user_id == user_id, MonthlyTotal.count <= 0).delete()
+    user_context(user_id).forget("monthly_totals")
+
+
+@metrics.timed
+def user_statistics(user_id, today):
+    # monthly totals come from the MonthlyTotal cache, the category breakdown from this month's expenses
+    monthly_totals = user_monthly_totals(user_id)
+    months = [(monthly_total.year, monthly_total.month) for monthly_total in monthly_totals]
+    totals = [monthly_total.total for monthly_total in monthly_totals]
+    first_day, last_day = month_bounds(today)
+    rows = db.session.query(Expense.date, Expense.currency, Expense.category, db.func.sum(Expense.amount))\
+        .filter(Expense.user_id == user_id, Expense.date >= first_day, Expense.date <= last_day)\
+        .group_by(Expense.date, Expense.currency, Expense.category)
+    columns = to_columns((day, to_base(amount, currency, day), category) for day, currency, category, amount in rows)
+    user_budget = user_budget_amount(user_id)
+    results = analyze(months, totals, user_budget, today, columns)
+    keys = [f"{month}-{year}" for year, month in months]
+    return {"budget": user_budget, "monthly_expenses": dict(zip(keys, totals)),
+            "remaining_budget": dict(zip(keys, results["remaining"])),
+            "average_daily_expense": dict(zip(keys, results["average_daily"])),
+            "trend": dict(zip(keys, results["trend"])), "categories": results["categories"],
+            "last_week": spent_since(columns, max(today - timedelta(days=6), first_day))}
+
+
+def rule_occurrences(rule, start, end):
+    # dates of the rule's occurrences from start (included) to end (excluded); short months end it early
+    year, month = start.year, start.month
+    while True:
+        occurrence = date(year, month, min(rule.day, monthrange(year, month)[1]))
+        if occurrence >= end or (rule.end_date and occurrence > rule.end_date):
+            return
+        if occurrence >= start:
+            yield occurrence
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def projection_end(today):
+    # first day after the PROJECTION_MONTHS months of the forecast, the current one included
+    months = today.year * 12 + today.month - 1 + PROJECTION_MONTHS
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def plan_occurrence(rule, day):
+    # rules are monthly: one occurrence per month at most
+    db.session.execute(db.insert(MonthlyPlan).values(rule_id=rule.id, year=day.year, month=day.month,
+                                                     user_id=rule.user_id, kind=rule.kind,
+                                                     category=rule.category or "",
+                                                     amount=to_base(rule.amount, rule.currency, day)))
+
+
+def claim_rule(rule, next_date, planned_until):
+    # moves the rule's dates on only if they are still those it was read with: the SELECT of refresh_recurring
+    # runs outside any transaction, so two requests of the same user may both find the rule due, and only the
+    # one whose UPDATE matches goes on to save and plan its occurrences
+    claimed = db.session.execute(
+        db.update(RecurringRule)
+        .where(RecurringRule.id == rule.id, RecurringRule.next_date == rule.next_date,
+               RecurringRule.planned_until == rule.planned_until)
+        .values(next_date=next_date, planned_until=planned_until)
+        .execution_options(synchronize_session=False)).rowcount
+    db.session.expire(rule, ["next_date", "planned_until"])
+    return claimed == 1
+
+
+def save_occurrence(rule, day):
+    if rule.kind == "expenses":
+        expense = Expense(user_id=rule.user_id, amount=rule.amount, currency=rule.currency,
+                          description=rule.description, date=day, category=rule.category)
+        db.session.add(expense)
+        update_monthly_total(rule.user_id, day, to_base(rule.amount, rule.currency, day), 1)
     else:
-        user_budget = 0
-    for expense in user_expenses:
-        expense_date = datetime.strptime(expense["date"], "%Y-%m-%d")
-        month = expense_date.month
-        year = expense_date.year
-        key = f"{month}-{year}"
-        if key not in monthly_expenses:
-            monthly_expenses[key] = 0
-        monthly_expenses[key] += float(expense["amount"])
-    remaining_budget = {key: user_budget - total for key, total in monthly_expenses.items()}
-    today = datetime.now()
-    last_day_of_month = monthrange(today.year, today.month)[1]
-    days_remaining = last_day_of_month - today.day + 1
-    total_remaining_budget = remaining_budget.get(f"{datetime.now().month}-{datetime.now().year}", 0)
-    average_expense_per_day = total_remaining_budget / days_remaining if days_remaining > 0 else 0
-    return monthly_expenses, remaining_budget, average_expense_per_day
+        db.session.add(Income(user_id=rule.user_id, amount=rule.amount, currency=rule.currency,
+                              description=rule.description, date=day))
+    # from now on it counts as a transaction rather than as planned
+    MonthlyPlan.query.filter_by(rule_id=rule.id, year=day.year, month=day.month).delete()
+
+
+def refresh_recurring(user_id, today):
+    # saves the occurrences that came due as transactions and plans those entering the forecast. The rules
+    # with nothing to do are left out by the query, so most requests cost this one indexed lookup
+    horizon, tomorrow = projection_end(today), today + timedelta(days=1)
+    rules = RecurringRule.query.filter(RecurringRule.user_id == user_id,
+                                       db.or_(RecurringRule.next_date <= today,
+                                              RecurringRule.planned_until < horizon)).all()
+    if not rules:
+        return
+    for rule in rules:
+        next_date, planned_until = rule.next_date, rule.planned_until
+        due = next_date is not None and next_date <= today
+        if not claim_rule(rule, next(rule_occurrences(rule, tomorrow, date.max), None) if due else next_date,
+                          max(planned_until, horizon)):
+            continue
+        for day in rule_occurrences(rule, planned_until, horizon):
+            plan_occurrence(rule, day)
+        if due:
+            for day in rule_occurrences(rule, next_date, tomorrow):
+                save_occurrence(rule, day)
+    db.session.commit()
+
+
+def new_recurring_rule(user_id, form, today):
+    start_date = form.start_date.data
+    rule = RecurringRule(user_id=user_id, kind=form.kind.data, amount=float(form.amount.data),
+                         currency=form.currency.data, description=form.description.data,
+                         category=form.category.data if form.kind.data == "expenses" else None,
+                         day=start_date.day, end_date=form.end_date.data, next_date=start_date,
+                         planned_until=start_date)
+    db.session.add(rule)
+    db.session.flush()
+    refresh_recurring(user_id, today)
+    return rule
+
+
+def remove_recurring_rule(rule):
+    # the transactions it already saved are kept
+    MonthlyPlan.query.filter_by(rule_id=rule.id).delete()
+    db.session.delete(rule)
+    db.session.commit()
+
+
+@metrics.timed
+def user_forecast(user_id, today):
+    # income and expenses of the next PROJECTION_MONTHS months: what was already saved plus what the recurring
+    # rules will add, all read from MonthlyTotal, MonthlyPlan and one range of the income index
+    first_day, horizon = today.replace(day=1), projection_end(today)
+    months = dict()
+    year, month = first_day.year, first_day.month
+    while date(year, month, 1) < horizon:
+        months[(year, month)] = {"income": 0, "expenses": 0, "planned_income": 0, "planned_expenses": 0}
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    for monthly_total in user_monthly_totals(user_id):
+        if (monthly_total.year, monthly_total.month) in months:
+            months[(monthly_total.year, monthly_total.month)]["expenses"] = monthly_total.total
+    income = db.session.query(Income.currency, Income.date, db.func.sum(Income.amount))\
+        .filter(Income.user_id == user_id, Income.date >= first_day, Income.date < horizon)\
+        .group_by(Income.currency, Income.date)
+    for currency, day, amount in income:
+        months[(day.year, day.month)]["income"] += to_base(amount, currency, day)
+    plans = db.session.query(MonthlyPlan.year, MonthlyPlan.month, MonthlyPlan.kind, db.func.sum(MonthlyPlan.amount))\
+        .filter(MonthlyPlan.user_id == user_id,
+                db.tuple_(MonthlyPlan.year, MonthlyPlan.month) >= (first_day.year, first_day.month))\
+        .group_by(MonthlyPlan.year, MonthlyPlan.month, MonthlyPlan.kind)
+    for year, month, kind, amount in plans:
+        if (year, month) in months:
+            months[(year, month)][f"planned_{kind}"] = amount
+    forecast = dict()
+    cumulative = 0
+    for (year, month), values in months.items():
+        values["balance"] = values["income"] + values["planned_income"] - values["expenses"] \
+            - values["planned_expenses"]
+        cumulative += values["balance"]
+        values["cumulative_balance"] = cumulative
+        forecast[f"{month}-{year}"] = values
+    return forecast
+
+
+def daily_allowance(user_id, today, statistics):
+    # what is left of this month's budget for each remaining day, the dashboard and /budget show the same figure;
+    # the recurring expenses still to come this month are not there to be spent
+    remaining_budget = statistics["remaining_budget"].get(f"{today.month}-{today.year}", statistics["budget"])
+    planned = db.session.query(db.func.sum(MonthlyPlan.amount))\
+        .filter_by(user_id=user_id, year=today.year, month=today.month, kind="expenses").scalar() or 0
+    days_remaining = monthrange(today.year, today.month)[1] - today.day + 1
+    return (remaining_budget - planned) / days_remaining
+
+
+def category_budgets(user_id, today, spent):
+    # spent: this month's expenses by category; what the recurring rules will still take is counted as spent
+    planned = dict(db.session.query(MonthlyPlan.category, db.func.sum(MonthlyPlan.amount))
+                   .filter_by(user_id=user_id, year=today.year, month=today.month, kind="expenses")
+                   .group_by(MonthlyPlan.category))
+    budgets = dict()
+    for category_budget in CategoryBudget.query.filter_by(user_id=user_id).order_by(CategoryBudget.category):
+        category = category_budget.category
+        budgets[category] = {"budget": category_budget.amount, "spent": spent.get(category, 0),
+                             "planned": planned.get(category, 0),
+                             "remaining": category_budget.amount - spent.get(category, 0) - planned.get(category, 0)}
+    return budgets
+
+
+def default_group(user_id):
+    # friends and expenses saved before groups existed end up in the user's first group
+    group = SharedGroup.query.filter_by(user_id=user_id).order_by(SharedGroup.id).first()
+    created = group is None
+    if created:
+        group = SharedGroup(user_id=user_id, name="Friends")
+        db.session.add(group)
+        db.session.flush()
+    # a read-only check first: the pages call this on every visit and there is almost never anything to move
+    orphaned = SharedFriend.query.filter_by(user_id=user_id, group_id=None).first() is not None \
+        or SharedExpense.query.filter_by(user_id=user_id, group_id=None).first() is not None
+    if orphaned:
+        SharedFriend.query.filter_by(user_id=user_id, group_id=None).update({"group_id": group.id})
+        SharedExpense.query.filter_by(user_id=user_id, group_id=None).update({"group_id": group.id})
+    if created or orphaned:
+        db.session.commit()
+    if orphaned:
+        rebuild_group_balances(group.id)
+    return group
 
 
 @app.route("/shared", methods=["GET", "POST"])
 @login_required
 def shared_expenses_manager():
+    if request.args.get("group"):
+        group = SharedGroup.query.filter_by(id=request.args.get("group", type=int), user_id=current_user.id)\
+            .first_or_404()
+    else:
+        group = default_group(current_user.id)
+    form_groups = SharedGroupForm()
     form_friends = SharedExpensesFriendForm()
     form_expenses = SharedExpenseForm()
-    user_shared_expenses = shared_expenses.get(str(current_user.id), list())
-    friends = [item["friend"] for item in user_shared_expenses if "friend" in item]
-    form_expenses.category.choices = [(cat, cat) for cat in categories.get(str(current_user.id), list())]
+    members = SharedFriend.query.filter_by(group_id=group.id).order_by(SharedFriend.id).all()
+    members_by_name = {member.name: member for member in members}
+    form_expenses.category.choices = [(cat, cat) for cat in user_categories(current_user.id)]
     form_expenses.currency.choices = [(curr, curr) for curr in possible_currency]
-    form_expenses.paid_by.choices = [(friend, friend) for friend in friends]
+    form_expenses.paid_by.choices = [(member.name, member.name) for member in members]
+    if form_groups.validate_on_submit():
+        new_group = SharedGroup(user_id=current_user.id, name=form_groups.group_name.data)
+        db.session.add(new_group)
+        db.session.commit()
+        flash(f"Group {new_group.name} created successfully")
+        return redirect(url_for("shared_expenses_manager", group=new_group.id))
     if form_friends.validate_on_submit():
         new_friend = form_friends.friends.data
-        if str(current_user.id) not in shared_expenses:
-            shared_expenses[str(current_user.id)] = list()
-        shared_expenses[str(current_user.id)].append({"friend": new_friend})
-        write_to_file(SHARED_EXPENSES_FILE, shared_expenses)
-        flash(f"New friend: {new_friend} added successfully")
-        return redirect(url_for("shared_expenses_manager"))
+        if new_friend not in members_by_name:
+            db.session.add(SharedFriend(user_id=current_user.id, group_id=group.id, name=new_friend))
+            db.session.commit()
+            flash(f"New friend: {new_friend} added successfully")
+        return redirect(url_for("shared_expenses_manager", group=group.id))
     if form_expenses.validate_on_submit():
-        expense_data = {
-            "amount": form_expenses.amount.data,
-            "currency": form_expenses.currency.data,
-            "paid_by": form_expenses.paid_by.data,
-            "date": form_expenses.date.data.strftime("%Y-%m-%d"),
-            "category": form_expenses.category.data
-        }
-        shared_expenses[str(current_user.id)].append(expense_data)
-        write_to_file(SHARED_EXPENSES_FILE, shared_expenses)
-        flash("Shared expense added successfully")
-        return redirect(url_for("shared_expenses_manager"))
-    friend_total = calculate_total_expenses(user_shared_expenses)
-    balance = split_expense(friend_total)
+        try:
+            new_shared_expense(group, members_by_name, form_expenses)
+        except ValueError as error:
+            # the form is shown again with what was typed, and the error under it
+            form_expenses.split.errors.append(f"Invalid split: {error}")
+        else:
+            flash("Shared expense added successfully")
+            return redirect(url_for("shared_expenses_manager", group=group.id))
+    # everything below costs O(members) plus one page of the group's ledger
+    ledger = SharedExpense.query.filter_by(group_id=group.id).order_by(SharedExpense.date, SharedExpense.id)
+    group_expenses, next_cursor = paginate(ledger, SharedExpense, request.args.get("after"))
+    next_url = url_for("shared_expenses_manager", group=group.id, after=next_cursor) if next_cursor else None
+    friend_total = calculate_total_expenses(members)
+    balance = split_expense(members)
     transactions = calculate_settlements(balance)
-    return render_template("shared_expenses.html", form_friends=form_friends, form_expenses=form_expenses,
-                           friends=friends, shared_expenses=user_shared_expenses, friend_total=friend_total,
-                           balance=balance, transactions=transactions)
+    groups = SharedGroup.query.filter_by(user_id=current_user.id).order_by(SharedGroup.id).all()
+    return render_template("shared_expenses.html", form_groups=form_groups, form_friends=form_friends,
+                           form_expenses=form_expenses, groups=groups, group=group,
+                           friends=list(members_by_name), shared_expenses=group_expenses, next_url=next_url,
+                           friend_total=friend_total, balance=balance, transactions=transactions)
 
 
 @app.route("/clear_shared", methods=["GET", "POST"])
 @login_required
 def clear_shared_expenses():
-    user_id = str(current_user.id)
-    if user_id in shared_expenses:
-        shared_expenses[user_id] = list()
-        write_to_file(SHARED_EXPENSES_FILE, shared_expenses)
-        flash("All friends and expenses have been cleared")
-    return redirect(url_for("shared_expenses_manager"))
-
-
-def calculate_total_expenses(shared_expense):
-    friend_total = dict()
-    for expense in shared_expense:
-        if "friend" in expense and "friend" not in friend_total:
-            friend_total[expense["friend"]] = 0
-        else:
-            paid_by = expense["paid_by"]
-            amount = float(expense["amount"])
-            if paid_by in friend_total:
-                friend_total[paid_by] += amount
-            else:
-                friend_total[paid_by] = amount
-    return friend_total
+    group = SharedGroup.query.filter_by(id=request.args.get("group", type=int), user_id=current_user.id)\
+        .first_or_404()
+    SharedFriend.query.filter_by(group_id=group.id).delete()
+    SharedExpense.query.filter_by(group_id=group.id).delete()
+    db.session.commit()
+    flash("All friends and expenses have been cleared")
+    return redirect(url_for("shared_expenses_manager", group=group.id))
+
+
+class CSVLine:
+    # lets csv.writer hand back each formatted row instead of writing it to a file
+    def write(self, value):
+        return value
+
+
+def export_value(value):
+    return value.strftime("%Y-%m-%d") if isinstance(value, date) else value
+
+
+def export_csv(rows, fields):
+    writer = csv.writer(CSVLine())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([export_value(getattr(row, field)) for field in fields])
+
+
+def export_ndjson(rows, fields):
+    for row in rows:
+        yield json.dumps({field: export_value(getattr(row, field)) for field in fields}) + "\n"
+
+
+@app.route("/export/<kind>.<export_format>")
+@login_required
+def export_transactions(kind, export_format):
+    if kind not in EXPORT_FIELDS or export_format not in ("csv", "ndjson"):
+        abort(404)
+    model, fields = EXPORT_FIELDS[kind]
+    try:
+        start_date = parse_date(request.args["start_date"]) if request.args.get("start_date") else None
+        end_date = parse_date(request.args["end_date"]) if request.args.get("end_date") else None
+    except ValueError:
+        abort(400)
+    query = filter_transactions(model, current_user.id, request.args.get("category"), start_date, end_date)
+    if kind == "shared" and request.args.get("group"):
+        group = SharedGroup.query.filter_by(id=request.args.get("group", type=int), user_id=current_user.id)\
+            .first_or_404()
+        query = query.filter(SharedExpense.group_id == group.id)
+    # rows are fetched in batches and sent as soon as they are formatted, nothing is built in memory
+    rows = query.yield_per(STREAM_BATCH_SIZE)
+    if export_format == "csv":
+        body, mimetype = export_csv(rows, fields), "text/csv"
+    else:
+        body, mimetype = export_ndjson(rows, fields), "application/x-ndjson"
+    return app.response_class(stream_with_context(body), mimetype=mimetype,
+                              headers={"Content-Disposition": f"attachment; filename={kind}.{export_format}"})
+
+
+def parse_split(text, friends):
+    # "Anna:2, Bob:1" splits an expense 2 to 1 between Anna and Bob; an empty split is even among all friends
+    if not text or not text.strip():
+        return {friend: 1 for friend in friends}
+    shares = dict()
+    for part in text.split(","):
+        name, separator, weight = part.rpartition(":")
+        name = name.strip()
+        if not separator:
+            raise ValueError(f"'{part.strip()}' is not a friend and a share, e.g. Anna:2")
+        if name not in friends:
+            raise ValueError(f"'{name}' is not one of your friends")
+        try:
+            shares[name] = float(weight)
+        except ValueError:
+            raise ValueError(f"the share of '{name}' is not a number")
+        if not math.isfinite(shares[name]) or shares[name] <= 0:
+            raise ValueError("shares must be positive numbers")
+    return shares
+
+
+def new_shared_expense(group, members_by_name, form):
+    shares = parse_split(form.split.data, members_by_name)
+    expense = SharedExpense(user_id=group.user_id, group_id=group.id, amount=float(form.amount.data),
+                            currency=form.currency.data, paid_by=form.paid_by.data, date=form.date.data,
+                            category=form.category.data, split=json.dumps(shares))
+    db.session.add(expense)
+    record_shared_expense(expense, shares)
+    db.session.commit()
+    return expense
+
+
+def balance_changes(expense, shares):
+    # {friend: [paid, owed]} added by one expense, in minor units of the base currency
+    amount = to_minor(to_base(expense.amount, expense.currency, expense.date))
+    changes = {name: [0, owed] for name, owed in split_shares(amount, shares).items()}
+    changes.setdefault(expense.paid_by, [0, 0])[0] += amount
+    return changes
+
+
+def record_shared_expense(expense, shares):
+    # the running totals are incremented by the database, so expenses added to the group at the same time by
+    # another worker are not lost
+    for name, (paid, owed) in balance_changes(expense, shares).items():
+        db.session.execute(db.update(SharedFriend)
+                           .where(SharedFriend.group_id == expense.group_id, SharedFriend.name == name)
+                           .values(paid=SharedFriend.paid + paid, owed=SharedFriend.owed + owed))
+
+
+def rebuild_group_balances(group_id):
+    friends_by_name = {friend.name: friend for friend in SharedFriend.query.filter_by(group_id=group_id)}
+    totals = {name: [0, 0] for name in friends_by_name}
+    for expense in SharedExpense.query.filter_by(group_id=group_id).order_by(SharedExpense.id)\
+            .yield_per(STREAM_BATCH_SIZE):
+        if expense.paid_by not in friends_by_name:
+            continue
+        shares = json.loads(expense.split) if expense.split else {name: 1 for name in friends_by_name}
+        for name, (paid, owed) in balance_changes(expense, shares).items():
+            if name in totals:
+                totals[name][0] += paid
+                totals[name][1] += owed
+    for name, (paid, owed) in totals.items():
+        friends_by_name[name].paid = paid
+        friends_by_name[name].owed = owed
+    db.session.commit()
+
+
+@metrics.timed
+def calculate_total_expenses(friends):
+    return {friend.name: from_minor(friend.paid) for friend in friends}
     
     
-def split_expense(friend_total):
-    gran_total = 0
-    for friend, total in friend_total.items():
-        gran_total += total
-    numb_friends = len(friend_total)
-    if numb_friends != 0:
-        spent_each_friend = gran_total / numb_friends
-    to_receive_to_send = dict()
-    for friend, total in friend_total.items():
-        to_receive_to_send[friend] = spent_each_friend - total
-    return to_receive_to_send
+@metrics.timed
+def split_expense(friends):
+    # positive: the friend still has to give that much, negative: the friend has to receive it
+    return {friend.name: from_minor(friend.owed - friend.paid) for friend in friends}
 
 
+@metrics.timed
 def calculate_settlements(to_receive_to_send):
-    payments = list()
-    positive_balances = list()
-    negative_balances = list()
-    for friend, balance in to_receive_to_send.items():
-        if balance > 0:
-            positive_balances.append((friend, balance))
-        elif balance < 0:
-            negative_balances.append((friend, -balance))
-    while positive_balances and negative_balances:
-        payee, amount_to_receive = positive_balances.pop()
-        payer, amount_to_pay = negative_balances.pop()
-        amount = min(amount_to_receive, amount_to_pay)
-        payments.append((payer, payee, amount))
-        amount_to_receive -= amount
-        amount_to_pay -= amount
-        if amount_to_receive > 0:
-            positive_balances.append((payee, amount_to_receive))
-        if amount_to_pay > 0:
-            negative_balances.append((payer, amount_to_pay))
-    return payments
+    balances = {friend: to_minor(balance) for friend, balance in to_receive_to_send.items()}
+    return [(payee, payer, from_minor(amount)) for payer, payee, amount in settle(balances)]
+
+
+# JSON API for the mobile client and scripts, versioned by its URL prefix. Requests are checked by the same
+# forms as the pages, filled from the JSON body; they need no CSRF token, since a page on another site cannot
+# send a JSON body without a CORS preflight. GET responses carry an ETag, so that a client revalidating with
+# If-None-Match gets an empty 304 when nothing changed, and bodies of API_GZIP_MIN_BYTES or more are gzipped.
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+# 401 instead of a redirect to the login page
+login_manager.blueprint_login_views["api"] = None
+
+
+def api_response(payload, status=200):
+    body = json.dumps(payload, separators=(",", ":"), default=export_value).encode("utf-8")
+    response = app.response_class(body, status=status, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if request.method == "GET" and status == 200:
+        # weak, so that the plain and the gzipped body share it
+        response.set_etag(hashlib.sha1(body).hexdigest(), weak=True)
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if len(body) >= API_GZIP_MIN_BYTES and "gzip" in request.accept_encodings:
+        response.set_data(gzip.compress(body, compresslevel=6))
+        response.content_encoding = "gzip"
+    return response
+
+
+@api.errorhandler(HTTPException)
+def api_error(error):
+    return api_response({"error": error.description}, error.code)
+
+
+def api_invalid(form):
+    return api_response({"error": "invalid data", "fields": form.errors}, 400)
+
+
+def api_form(form_class, current=None):
+    # fields missing from the body keep their current values, so a PATCH only sends what changes
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        abort(400, "expected a JSON object")
+    data = dict(current or dict(), **payload)
+    return form_class(formdata=MultiDict({name: str(value) for name, value in data.items() if value is not None}),
+                      meta={"csrf": False})
+
+
+def api_fields(available):
+    # ?fields=date,amount leaves the other fields out
+    if not request.args.get("fields"):
+        return available
+    fields = request.args["fields"].split(",")
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        abort(400, f"unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def api_row(row, fields):
+    return {field: getattr(row, field) for field in fields}
+
+
+def api_filters():
+    form = FilterForm(formdata=request.args, meta={"csrf": False})
+    form.category.choices = [("None", "None")] + [(cat, cat) for cat in user_categories(current_user.id)]
+    if not form.validate():
+        abort(400, "invalid filters: " + ", ".join(form.errors))
+    return {name: value for name, value in form.data.items()
+            if name in ("category", "start_date", "end_date") and value and value != "None"}
+
+
+def api_list(kind, query):
+    model, fields = EXPORT_FIELDS[kind]
+    fields = api_fields(fields)
+    rows, next_cursor = paginate(query, model, request.args.get("after"))
+    return api_response({kind: [api_row(row, fields) for row in rows], "next": next_cursor})
+
+
+def api_group_summary(group):
+    members = SharedFriend.query.filter_by(group_id=group.id).order_by(SharedFriend.id).all()
+    paid = calculate_total_expenses(members)
+    balance = split_expense(members)
+    return {"id": group.id, "name": group.name,
+            "members": [{"name": name, "paid": paid[name], "balance": balance[name]} for name in balance],
+            "settlements": [{"from": payer, "to": payee, "amount": amount}
+                            for payee, payer, amount in calculate_settlements(balance)]}
+
+
+@api.route("/login", methods=["POST"])
+def api_login():
+    form = api_form(LoginForm)
+    if not form.validate():
+        return api_invalid(form)
+    user = User.query.filter_by(username=form.username.data).first()
+    if user is None or not passwords.check_password(user.password, form.password.data):
+        abort(401, "wrong username or password")
+    login_user(user)
+    return api_response({"id": user.id, "username": user.username})
+
+
+@api.route("/logout", methods=["POST"])
+@login_required
+def api_logout():
+    logout_user()
+    return "", 204
+
+
+@api.route("/expenses", methods=["GET", "POST"])
+@login_required
+def api_expenses():
+    if request.method == "GET":
+        return api_list("expenses", user_context().expenses(**api_filters()))
+    form = api_form(ExpenseForm)
+    form.currency.choices = [(curr, curr) for curr in possible_currency]
+    form.category.choices = [(cat, cat) for cat in user_categories(current_user.id)]
+    if not form.validate():
+        return api_invalid(form)
+    expense = new_expense(current_user.id, form)
+    return api_response(api_row(expense, EXPORT_FIELDS["expenses"][1]), 201)
+
+
+@api.route("/expenses/<int:expense_id>", methods=["GET", "PATCH", "DELETE"])
+@login_required
+def api_expense(expense_id):
+    expense = user_expense(expense_id)
+    if expense is None:
+        abort(404, "no such expense")
+    fields = EXPORT_FIELDS["expenses"][1]
+    if request.method == "DELETE":
+        remove_expense(expense)
+        return "", 204
+    if request.method == "PATCH":
+        form = api_form(ExpenseForm, api_row(expense, fields))
+        form.currency.choices = [(curr, curr) for curr in possible_currency]
+        form.category.choices = [(cat, cat) for cat in expense_categories(expense)]
+        if not form.validate():
+            return api_invalid(form)
+        save_expense(expense, form)
+    return api_response(api_row(expense, api_fields(fields)))
+
+
+@api.route("/income", methods=["GET", "POST"])
+@login_required
+def api_income():
+    if request.method == "GET":
+        return api_list("income", filter_transactions(Income, current_user.id, **api_filters()))
+    form = api_form(IncomeForm)
+    form.currency.choices = [(curr, curr) for curr in possible_currency]
+    if not form.validate():
+        return api_invalid(form)
+    income = new_income(current_user.id, form)
+    return api_response(api_row(income, EXPORT_FIELDS["income"][1]), 201)
+
+
+@api.route("/budget", methods=["GET", "PUT"])
+@login_required
+def api_budget():
+    if request.method == "PUT":
+        form = api_form(BudgetForm)
+        if not form.validate():
+            return api_invalid(form)
+        set_budget(current_user.id, float(form.budget.data))
+    statistics = user_statistics(current_user.id, datetime.now().date())
+    return api_response({name: statistics[name] for name in api_fields(list(statistics))})
+
+
+@api.route("/forecast")
+@login_required
+def api_forecast():
+    today = datetime.now().date()
+    statistics = user_statistics(current_user.id, today)
+    return api_response({"months": user_forecast(current_user.id, today),
+                         "category_budgets": category_budgets(current_user.id, today, statistics["categories"])})
+
+
+@api.route("/categories", methods=["GET", "POST"])
+@login_required
+def api_categories():
+    if request.method == "POST":
+        form = api_form(CategoryForm)
+        if not form.validate():
+            return api_invalid(form)
+        if form.name.data in user_categories(current_user.id):
+            abort(409, "the category already exists")
+        new_user_category(current_user.id, form.name.data)
+        return api_response({"categories": user_categories(current_user.id)}, 201)
+    return api_response({"categories": user_categories(current_user.id)})
+
+
+@api.route("/categories/<name>", methods=["DELETE"])
+@login_required
+def api_category(name):
+    if name not in user_categories(current_user.id):
+        abort(404, "no such category")
+    remove_user_category(current_user.id, name)
+    return "", 204
+
+
+@api.route("/shared", methods=["GET", "POST"])
+@login_required
+def api_shared_groups():
+    if request.method == "POST":
+        form = api_form(SharedGroupForm)
+        if not form.validate():
+            return api_invalid(form)
+        group = SharedGroup(user_id=current_user.id, name=form.group_name.data)
+        db.session.add(group)
+        db.session.commit()
+        return api_response(api_group_summary(group), 201)
+    default_group(current_user.id)
+    groups = SharedGroup.query.filter_by(user_id=current_user.id).order_by(SharedGroup.id)
+    return api_response({"groups": [{"id": group.id, "name": group.name} for group in groups]})
+
+
+@api.route("/shared/<int:group_id>")
+@login_required
+def api_shared_group(group_id):
+    # members with what they paid and their balance, and the transfers that settle the group
+    group = SharedGroup.query.filter_by(id=group_id, user_id=current_user.id).first_or_404()
+    return api_response(api_group_summary(group))
+
+
+@api.route("/shared/<int:group_id>/friends", methods=["POST"])
+@login_required
+def api_shared_friends(group_id):
+    group = SharedGroup.query.filter_by(id=group_id, user_id=current_user.id).first_or_404()
+    form = api_form(SharedExpensesFriendForm)
+    if not form.validate():
+        return api_invalid(form)
+    if SharedFriend.query.filter_by(group_id=group.id, name=form.friends.data).first() is not None:
+        abort(409, "the friend is already in the group")
+    db.session.add(SharedFriend(user_id=current_user.id, group_id=group.id, name=form.friends.data))
+    db.session.commit()
+    return api_response(api_group_summary(group), 201)
+
+
+@api.route("/shared/<int:group_id>/expenses", methods=["GET", "POST"])
+@login_required
+def api_shared_expenses(group_id):
+    group = SharedGroup.query.filter_by(id=group_id, user_id=current_user.id).first_or_404()
+    if request.method == "GET":
+        ledger = SharedExpense.query.filter_by(group_id=group.id).order_by(SharedExpense.date, SharedExpense.id)
+        return api_list("shared", ledger)
+    members_by_name = {member.name: member for member in SharedFriend.query.filter_by(group_id=group.id)}
+    form = api_form(SharedExpenseForm)
+    form.category.choices = [(cat, cat) for cat in user_categories(current_user.id)]
+    form.currency.choices = [(curr, curr) for curr in possible_currency]
+    form.paid_by.choices = [(name, name) for name in members_by_name]
+    if not form.validate():
+        return api_invalid(form)
+    try:
+        new_shared_expense(group, members_by_name, form)
+    except ValueError as error:
+        abort(400, str(error))
+    return api_response(api_group_summary(group), 201)
+
+
+app.register_blueprint(api)
+
+
+def json_users(filepath, skipped):
+    # (user id, entries) of one of the old JSON files, which the old app wrote without validating anything: a file
+    # that is not an object of users, or a user whose id is not a number, is skipped as a whole
+    data = read_from_file(filepath)
+    if not isinstance(data, dict):
+        skipped.append((filepath, "-", f"expected an object of users, found a {type(data).__name__}"))
+        return
+    for user_id, entries in data.items():
+        if not str(user_id).isdigit():
+            skipped.append((filepath, user_id, "the user id is not a number"))
+            continue
+        yield int(user_id), entries
+
+
+def json_entries(filepath, user_id, entries, build, skipped):
+    # the models built from a user's entries; a malformed entry is skipped and reported, the others are imported
+    if not isinstance(entries, list):
+        skipped.append((filepath, user_id, f"expected a list of entries, found a {type(entries).__name__}"))
+        return list()
+    models = list()
+    for entry in entries:
+        try:
+            models.append(build(user_id, entry))
+        except (KeyError, TypeError, ValueError) as error:
+            skipped.append((filepath, user_id, f"{json.dumps(entry, ensure_ascii=False)[:100]}: {error!r}"))
+    return models
+
+
+def json_amount(value):
+    amount = float(value)
+    if not math.isfinite(amount):
+        raise ValueError(f"invalid amount {value!r}")
+    return amount
+
+
+def json_text(value):
+    if not isinstance(value, str):
+        raise TypeError(f"expected a string, found {value!r}")
+    return value
+
+
+def json_expense(user_id, expense):
+    return Expense(user_id=user_id, amount=json_amount(expense["amount"]), currency=json_text(expense["currency"]),
+                   description=json_text(expense["description"]), date=parse_date(expense["date"]),
+                   category=json_text(expense["category"]))
+
+
+def json_income(user_id, income):
+    return Income(user_id=user_id, amount=json_amount(income["amount"]), currency=json_text(income["currency"]),
+                  description=json_text(income["description"]), date=parse_date(income["date"]))
+
+
+def json_shared_entry(user_id, entry):
+    # the old file mixed the friends and the expenses of a user
+    if "friend" in entry:
+        return SharedFriend(user_id=user_id, name=json_text(entry["friend"]))
+    return SharedExpense(user_id=user_id, amount=json_amount(entry["amount"]), currency=json_text(entry["currency"]),
+                         paid_by=json_text(entry["paid_by"]), date=parse_date(entry["date"]),
+                         category=json_text(entry["category"]))
+
+
+def import_json_data():
+    # users that already have rows of a kind are skipped, so running the import twice does not duplicate data.
+    # Returns the count of each kind imported and the (file, user, reason) of every entry skipped
+    imported = dict()
+    skipped = list()
+    for user_id, user_expenses in json_users(EXPENSES_FILE, skipped):
+        if Expense.query.filter_by(user_id=user_id).first() is None:
+            expenses = json_entries(EXPENSES_FILE, user_id, user_expenses, json_expense, skipped)
+            db.session.add_all(expenses)
+            imported["expenses"] = imported.get("expenses", 0) + len(expenses)
+    for user_id, user_income in json_users(INCOME_FILE, skipped):
+        if Income.query.filter_by(user_id=user_id).first() is None:
+            income = json_entries(INCOME_FILE, user_id, user_income, json_income, skipped)
+            db.session.add_all(income)
+            imported["income"] = imported.get("income", 0) + len(income)
+    for user_id, user_categories_list in json_users(CATEGORIES_FILE, skipped):
+        if Category.query.filter_by(user_id=user_id).first() is None:
+            categories = json_entries(CATEGORIES_FILE, user_id, user_categories_list,
+                                      lambda user_id, name: Category(user_id=user_id, name=json_text(name)), skipped)
+            db.session.add_all(categories)
+            imported["categories"] = imported.get("categories", 0) + len(categories)
+    for user_id, amount in json_users(BUDGET_FILE, skipped):
+        if db.session.get(Budget, user_id) is None:
+            budgets = json_entries(BUDGET_FILE, user_id, [amount],
+                                   lambda user_id, value: Budget(user_id=user_id, amount=json_amount(value)), skipped)
+            db.session.add_all(budgets)
+            imported["budgets"] = imported.get("budgets", 0) + len(budgets)
+    shared_users = list()
+    for user_id, entries in json_users(SHARED_EXPENSES_FILE, skipped):
+        if SharedFriend.query.filter_by(user_id=user_id).first() is not None:
+            continue
+        shared_users.append(user_id)
+        shared = json_entries(SHARED_EXPENSES_FILE, user_id, entries, json_shared_entry, skipped)
+        db.session.add_all(shared)
+        imported["shared entries"] = imported.get("shared entries", 0) + len(shared)
+    db.session.commit()
+    for user_id in shared_users:
+        default_group(user_id)
+    return imported, skipped
+
+
+@app.cli.command("import-json")
+def import_json_command():
+    with file_lock(os.path.join(app.instance_path, "import-json")):
+        imported, skipped = import_json_data()
+    for kind, count in imported.items():
+        print(f"Imported {count} {kind}")
+    for filepath, user_id, reason in skipped:
+        print(f"Skipped in {filepath}, user {user_id}: {reason}")
+    if skipped:
+        print(f"Skipped {len(skipped)} malformed entries")
+
+
+@app.cli.command("rebuild-totals")
+def rebuild_totals_command():
+    # monthly totals are converted when expenses are saved: run this after past rates were corrected
+    deleted = MonthlyTotal.query.delete()
+    # the recurring transactions still to come are planned again, with the corrected rates
+    MonthlyPlan.query.delete()
+    for rule in RecurringRule.query:
+        rule.planned_until = rule.next_date or rule.planned_until
+    db.session.commit()
+    print(f"Dropped {deleted} monthly totals, they are rebuilt from the expenses when next needed")
 
 
 @app.template_filter("absolute")
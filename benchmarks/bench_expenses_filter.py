@@ -0,0 +1,85 @@
+# Times the /expenses filters on synthetic histories, against the list comprehensions they replaced.
+# Run from the repository root: python benchmarks/bench_expenses_filter.py --sizes 10000 100000
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DATABASE_DIR, "bench.db")
+
+from app import app, db, User, Expense, filter_expenses  # noqa: E402
+
+CATEGORIES = ["food", "rent", "transport", "fun", "health", "travel", "gifts", "bills"]
+FIRST_DAY = date(2015, 1, 1)
+
+
+def generate_expenses(user_id, size, seed=0):
+    generator = random.Random(seed)
+    return [{"user_id": user_id, "amount": round(generator.uniform(1, 200), 2), "currency": "€",
+             "description": f"expense {i}", "date": FIRST_DAY + timedelta(days=generator.randrange(3650)),
+             "category": generator.choice(CATEGORIES)} for i in range(size)]
+
+
+def linear_filter(user_expenses, category, start_date, end_date):
+    # the pre-index implementation of expenses_view
+    if category:
+        user_expenses = [expense for expense in user_expenses if expense["category"] == category]
+    if start_date:
+        user_expenses = [expense for expense in user_expenses
+                         if datetime.strptime(expense["date"], "%Y-%m-%d").date() >= start_date]
+    if end_date:
+        user_expenses = [expense for expense in user_expenses
+                         if datetime.strptime(expense["date"], "%Y-%m-%d").date() <= end_date]
+    return user_expenses
+
+
+def best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run(size, repeat):
+    with app.app_context():
+        user = User(username=f"bench{size}", password="-")
+        db.session.add(user)
+        db.session.commit()
+        rows = generate_expenses(user.id, size)
+        db.session.execute(db.insert(Expense), rows)
+        db.session.commit()
+        json_rows = [dict(row, date=row["date"].strftime("%Y-%m-%d")) for row in rows]
+        cases = {
+            "category": ("food", None, None),
+            "one month": (None, date(2020, 3, 1), date(2020, 3, 31)),
+            "category + one month": ("food", date(2020, 3, 1), date(2020, 3, 31)),
+            "category + one year": ("food", date(2020, 1, 1), date(2020, 12, 31)),
+        }
+        print(f"\n{size} expenses")
+        print(f"{'filter':<24}{'rows':>8}{'indexed ms':>12}{'linear ms':>12}")
+        for name, (category, start_date, end_date) in cases.items():
+            found = filter_expenses(user.id, category, start_date, end_date).count()
+            indexed = best_time(lambda: filter_expenses(user.id, category, start_date, end_date).all(), repeat)
+            linear = best_time(lambda: linear_filter(json_rows, category, start_date, end_date), repeat)
+            print(f"{name:<24}{found:>8}{indexed * 1000:>12.2f}{linear * 1000:>12.2f}")
+            db.session.expunge_all()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    arguments = parser.parse_args()
+    for size in arguments.sizes:
+        run(size, arguments.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Measures how many /login requests per second the app serves at several bcrypt costs, with the hashes computed
+# inline and in the process pool, to choose BCRYPT_LOG_ROUNDS and PASSWORD_HASH_WORKERS for a machine.
+# Run from the repository root: python benchmarks/bench_logins.py --rounds 10 12 --threads 8
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DATABASE_DIR, "bench.db")
+
+import passwords  # noqa: E402
+from app import app, db, User  # noqa: E402
+
+PASSWORD = "benchmark-password"
+
+
+def create_user(username, rounds):
+    with app.app_context():
+        db.session.add(User(username=username, password=passwords.hash_password(PASSWORD, rounds)))
+        db.session.commit()
+
+
+def log_in(username, count):
+    client = app.test_client()
+    for _ in range(count):
+        response = client.post("/login", data={"username": username, "password": PASSWORD})
+        assert response.status_code == 302, response.status_code
+
+
+def warm_up(workers):
+    # configure() drops the pool: its processes are started here, one hash for each, and not by the timed logins
+    with ThreadPoolExecutor(max(1, workers)) as threads:
+        list(threads.map(lambda _: passwords.hash_password(PASSWORD, 4), range(max(1, workers))))
+
+
+def logins_per_second(username, threads, logins):
+    per_thread = max(1, logins // threads)
+    workers = [threading.Thread(target=log_in, args=(username, per_thread)) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, nargs="+", default=[4, 8, 10, 12])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=passwords.DEFAULT_WORKERS)
+    arguments = parser.parse_args()
+    app.config["WTF_CSRF_ENABLED"] = False
+    print(f"{arguments.threads} threads, pool of {arguments.workers} processes")
+    print(f"{'rounds':<8}{'inline/s':>12}{'pool/s':>12}")
+    for rounds in arguments.rounds:
+        username = f"bench{rounds}"
+        create_user(username, rounds)
+        results = list()
+        for workers in (0, arguments.workers):
+            passwords.configure(rounds, workers)
+            warm_up(workers)
+            results.append(logins_per_second(username, arguments.threads, arguments.logins))
+        print(f"{rounds:<8}{results[0]:>12.1f}{results[1]:>12.1f}")
+    passwords.configure(workers=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+# Benchmarks what the pages run, the statistics, forecast and settlement helpers, the import of transactions and
+# the main pages themselves, on synthetic users, and saves the results as JSON.
+# Run from the repository root: python benchmarks/bench_suite.py --sizes 1000 100000 [--compare old.json]
+# Each size is one user with that many expenses, a tenth as much income and a shared group of --friends people.
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DATABASE_DIR = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(DATABASE_DIR, "bench.db")
+
+import passwords  # noqa: E402
+from rates import refresh_rates  # noqa: E402
+from app import app, db, User, Expense, Income, Category, Budget, SharedGroup, SharedFriend, SharedExpense, \
+    user_statistics, user_forecast, calculate_total_expenses, split_expense, calculate_settlements, import_rows, \
+    rebuild_group_balances  # noqa: E402
+
+CATEGORIES = ["food", "rent", "transport", "fun", "health", "travel", "gifts", "bills"]
+CURRENCIES = ["¥", "€", "£", "$"]
+ROUTES = ["/dashboard", "/expenses", "/budget", "/forecast", "/shared"]
+IMPORT_ROWS = 1000
+PASSWORD = "benchmark-password"
+INSERT_BATCH_SIZE = 10000
+
+
+def insert_rows(model, rows):
+    # in batches, so that a million rows are never all in memory
+    batch = list()
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= INSERT_BATCH_SIZE:
+            db.session.execute(db.insert(model), batch)
+            batch = list()
+    if batch:
+        db.session.execute(db.insert(model), batch)
+
+
+def create_user(size, friends, seed=0):
+    generator = random.Random(seed)
+    last_day = date.today()
+
+    def random_day():
+        return last_day - timedelta(days=generator.randrange(3 * 365))
+
+    with app.app_context():
+        user = User(username=f"bench{size}", password=passwords.hash_password(PASSWORD, 4))
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        db.session.add_all([Category(user_id=user_id, name=name) for name in CATEGORIES])
+        db.session.add(Budget(user_id=user_id, amount=2000))
+        insert_rows(Expense, ({"user_id": user_id, "amount": round(generator.uniform(1, 200), 2),
+                               "currency": generator.choice(CURRENCIES), "description": f"expense {i}",
+                               "date": random_day(), "category": generator.choice(CATEGORIES)}
+                              for i in range(size)))
+        insert_rows(Income, ({"user_id": user_id, "amount": round(generator.uniform(100, 3000), 2),
+                              "currency": generator.choice(CURRENCIES), "description": f"income {i}",
+                              "date": random_day()} for i in range(max(1, size // 10))))
+        group = SharedGroup(user_id=user_id, name="Benchmark")
+        db.session.add(group)
+        db.session.flush()
+        names = [f"friend {i}" for i in range(friends)]
+        db.session.add_all([SharedFriend(user_id=user_id, group_id=group.id, name=name) for name in names])
+        insert_rows(SharedExpense, ({"user_id": user_id, "group_id": group.id,
+                                     "amount": round(generator.uniform(5, 300), 2),
+                                     "currency": generator.choice(CURRENCIES), "paid_by": generator.choice(names),
+                                     "date": random_day(), "category": generator.choice(CATEGORIES),
+                                     "split": json.dumps({name: 1 for name in generator.sample(names, 3)})}
+                                    for _ in range(max(1, size // 10))))
+        db.session.commit()
+        rebuild_group_balances(group.id)
+        return user_id, group.id
+
+
+def timings(function, repeat):
+    # seconds of each call; every call gets a fresh app context, so nothing is reused from the previous one
+    results = list()
+    for _ in range(repeat):
+        with app.app_context():
+            start = time.perf_counter()
+            function()
+            results.append(time.perf_counter() - start)
+    return results
+
+
+def summary(seconds, peak_bytes=None):
+    seconds = sorted(seconds)
+    result = {"runs": len(seconds), "p50_ms": percentile(seconds, 0.5) * 1000,
+              "p99_ms": percentile(seconds, 0.99) * 1000, "mean_ms": sum(seconds) / len(seconds) * 1000}
+    if peak_bytes is not None:
+        result["peak_memory_kb"] = peak_bytes / 1024
+    return result
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def measure(function, repeat):
+    # timed first without tracemalloc, which slows allocations down, then once more for the peak memory
+    seconds = timings(function, repeat)
+    tracemalloc.start()
+    timings(function, 1)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summary(seconds, peak)
+
+
+def group_friends(group_id):
+    return SharedFriend.query.filter_by(group_id=group_id).order_by(SharedFriend.id).all()
+
+
+def bench_helpers(user_id, group_id, repeat):
+    results = dict()
+    today = date.today()
+    results["user_statistics"] = measure(lambda: user_statistics(user_id, today), repeat)
+    results["user_forecast"] = measure(lambda: user_forecast(user_id, today), repeat)
+    with app.app_context():
+        friends = group_friends(group_id)
+        db.session.expunge_all()
+    results["calculate_total_expenses"] = measure(lambda: calculate_total_expenses(friends), repeat)
+    results["split_expense"] = measure(lambda: split_expense(friends), repeat)
+    balance = split_expense(friends)
+    results["calculate_settlements"] = measure(lambda: calculate_settlements(balance), repeat)
+    return results
+
+
+def bench_writes(user_id, size, repeat):
+    # a statement of IMPORT_ROWS rows through import_rows, and single expenses through /add_expense (new_expense)
+    generator = random.Random(size)
+    rows = [(line, {"date": (date.today() - timedelta(days=generator.randrange(365))).isoformat(),
+                    "amount": str(round(generator.uniform(1, 200), 2)), "currency": "EUR",
+                    "description": f"imported {line}", "category": generator.choice(CATEGORIES)})
+            for line in range(IMPORT_ROWS)]
+    results = {"import_rows": measure(lambda: import_rows(user_id, rows, "expenses", "", CATEGORIES), repeat)}
+    client = log_in(size)
+    expense = {"amount": "12.50", "currency": "€", "description": "benchmark", "date": date.today().isoformat(),
+               "category": "food"}
+    results["POST /add_expense"] = request_timings(client, "post", "/add_expense", repeat, 302, data=expense)
+    return results
+
+
+def log_in(size):
+    client = app.test_client()
+    response = client.post("/login", data={"username": f"bench{size}", "password": PASSWORD})
+    assert response.status_code == 302, response.status_code
+    return client
+
+
+def request_timings(client, method, url, repeat, status, **arguments):
+    # the test client pushes its own contexts for every request
+    def send():
+        response = getattr(client, method)(url, **arguments)
+        assert response.status_code == status, (url, response.status_code)
+
+    seconds = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        send()
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    send()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return summary(seconds, peak)
+
+
+def bench_routes(size, group_id, repeat):
+    client = log_in(size)
+    results = dict()
+    for route in ROUTES:
+        url = f"{route}?group={group_id}" if route == "/shared" else route
+        results[route] = request_timings(client, "get", url, repeat, 200)
+    return results
+
+
+def compare(results, previous):
+    print(f"\n{'size':<10}{'benchmark':<32}{'p50 ms':>10}{'before':>10}{'change':>10}")
+    for size, groups in results["sizes"].items():
+        for group, benchmarks in groups.items():
+            for name, result in benchmarks.items():
+                before = previous.get("sizes", dict()).get(size, dict()).get(group, dict()).get(name)
+                if before is None:
+                    continue
+                change = result["p50_ms"] / before["p50_ms"] - 1 if before["p50_ms"] else 0
+                print(f"{size:<10}{name:<32}{result['p50_ms']:>10.2f}{before['p50_ms']:>10.2f}{change:>+10.0%}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--friends", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", default=f"benchmarks/results-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    parser.add_argument("--compare", help="results of an earlier run to compare with")
+    arguments = parser.parse_args()
+    app.config["WTF_CSRF_ENABLED"] = False
+    passwords.configure(workers=0)
+    # the pages load the rates before every request; the helpers are called outside of one and would count every
+    # amount at face value
+    refresh_rates()
+    results = {"started": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+               "machine": platform.machine(), "repeat": arguments.repeat, "friends": arguments.friends,
+               "sizes": dict()}
+    for size in arguments.sizes:
+        start = time.perf_counter()
+        user_id, group_id = create_user(size, arguments.friends)
+        print(f"{size} expenses: data generated in {time.perf_counter() - start:.1f} s")
+        results["sizes"][str(size)] = {"helpers": bench_helpers(user_id, group_id, arguments.repeat),
+                                       "routes": bench_routes(size, group_id, arguments.repeat),
+                                       "writes": bench_writes(user_id, size, arguments.repeat)}
+        print(f"{'benchmark':<32}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>12}")
+        for benchmarks in results["sizes"][str(size)].values():
+            for name, result in benchmarks.items():
+                print(f"{name:<32}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}{result['peak_memory_kb']:>12.0f}")
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nresults saved to {arguments.output}")
+    if arguments.compare:
+        with open(arguments.compare, "r") as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    main()
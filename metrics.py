@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from functools import wraps
+
+# Opt-in timing of requests, templates and hot functions, kept as histograms in this process and served in the
+# Prometheus text format by /metrics. While disabled, an instrumented function costs one flag check per call.
+# Under several worker processes each scrape is answered by one of them: the pid label keeps their series apart.
+PREFIX = "expenses_"
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DESCRIPTIONS = {
+    "request_duration_seconds": "Time spent handling a request, until the response is returned",
+    "template_duration_seconds": "Time spent rendering a template",
+    "function_duration_seconds": "Time spent in an instrumented function",
+    "db_query_duration_seconds": "Time spent executing an SQL statement",
+}
+
+_enabled = False
+_histograms = dict()
+_lock = threading.Lock()
+
+
+def configure(enabled):
+    global _enabled
+    _enabled = enabled
+
+
+def enabled():
+    return _enabled
+
+
+def observe(name, seconds, **labels):
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        # buckets are cumulative: each one counts the observations up to its bound
+        for position, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][position] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+def timed(function):
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            observe("function_duration_seconds", time.perf_counter() - start, function=name)
+    return wrapper
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    escaped = [(key, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for key, value in pairs]
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+def render():
+    with _lock:
+        histograms = sorted((key, dict(value, buckets=list(value["buckets"]))) for key, value in _histograms.items())
+    lines = list()
+    described = set()
+    pid = os.getpid()
+    for (name, labels), histogram in histograms:
+        metric = PREFIX + name
+        if name not in described:
+            described.add(name)
+            lines.append(f"# HELP {metric} {DESCRIPTIONS.get(name, name)}")
+            lines.append(f"# TYPE {metric} histogram")
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append(f"{metric}_bucket{_labels(labels, pid=pid, le=bound)} {count}")
+        lines.append(f"{metric}_bucket{_labels(labels, pid=pid, le='+Inf')} {histogram['count']}")
+        lines.append(f"{metric}_sum{_labels(labels, pid=pid)} {histogram['sum']}")
+        lines.append(f"{metric}_count{_labels(labels, pid=pid)} {histogram['count']}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,64 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+# Password hashing for /login and /register. Bcrypt is slow on purpose (2 ** rounds iterations), so the
+# hashes are computed in a small pool of worker processes: the request thread only waits for the result,
+# without holding the GIL, and no more than `workers` hashes run at the same time.
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# the workers are not forked from the web process, whose threads may hold locks (the database pool, logging)
+# that would stay locked forever in the child; forkserver is not available on Windows
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+_rounds = DEFAULT_ROUNDS
+_workers = DEFAULT_WORKERS
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def configure(rounds=DEFAULT_ROUNDS, workers=DEFAULT_WORKERS):
+    # workers=0 hashes in the calling thread, e.g. where processes cannot be started
+    global _rounds, _workers, _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False)
+        _rounds, _workers, _pool = rounds, workers, None
+
+
+def _executor():
+    global _pool
+    with _pool_lock:
+        if _pool is None and _workers > 0:
+            _pool = ProcessPoolExecutor(max_workers=_workers,
+                                        mp_context=multiprocessing.get_context(START_METHOD))
+        return _pool
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def _check(hashed, password):
+    if isinstance(hashed, str):
+        hashed = hashed.encode("utf-8")
+    return bcrypt.checkpw(password.encode("utf-8"), hashed)
+
+
+def _run(function, *arguments):
+    pool = _executor()
+    if pool is None:
+        return function(*arguments)
+    return pool.submit(function, *arguments).result()
+
+
+def hash_password(password, rounds=None):
+    return _run(_hash, password, _rounds if rounds is None else rounds)
+
+
+def check_password(hashed, password):
+    # hashes made with a different cost are still checked: the cost is part of the hash
+    return _run(_check, hashed, password)
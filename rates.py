@@ -0,0 +1,52 @@
+import json
+import os
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+# Exchange rates to the base currency, read from a local JSON file:
+# {"base": "¥", "rates": {"€": {"2024-01-01": 7.85, ...}, ...}}
+# The rate used for a day is the latest one published on or before it (the earliest one for older days).
+RATES_FILE = "exchange_rates.json"
+
+_base_currency = "¥"
+_rates = dict()
+_generation = None
+
+
+def refresh_rates(filepath=RATES_FILE):
+    # cheap enough to call on every request: the file is only parsed again when it changes
+    global _base_currency, _rates, _generation
+    generation = os.stat(filepath).st_mtime_ns if os.path.exists(filepath) else None
+    if generation == _generation:
+        return
+    data = dict()
+    if generation is not None:
+        with open(filepath, "r") as file:
+            data = json.load(file)
+    rates = dict()
+    for currency, published in data.get("rates", dict()).items():
+        days = sorted(published)
+        rates[currency] = ([datetime.strptime(day, "%Y-%m-%d").date() for day in days],
+                           [float(published[day]) for day in days])
+    _base_currency = data.get("base", "¥")
+    _rates = rates
+    _generation = generation
+    rate_on.cache_clear()
+
+
+def base_currency():
+    return _base_currency
+
+
+@lru_cache(maxsize=65536)
+def rate_on(currency, day):
+    if currency == _base_currency or currency not in _rates:
+        # currencies without published rates are counted at face value
+        return 1.0
+    days, rates = _rates[currency]
+    return rates[max(bisect_right(days, day) - 1, 0)]
+
+
+def to_base(amount, currency, day):
+    return float(amount) * rate_on(currency, day)
@@ -0,0 +1,119 @@
+import heapq
+
+# Settling shared expenses with integer amounts in minor units (cents), so balances always add up to
+# exactly zero and no payment of a fraction of a cent is left over.
+# Groups of up to EXACT_LIMIT people are settled with the fewest transfers possible; larger groups use a
+# greedy heuristic that needs at most one transfer less than the number of people with a balance.
+EXACT_LIMIT = 12
+
+
+def to_minor(amount):
+    return int(round(float(amount) * 100))
+
+
+def from_minor(units):
+    return units / 100
+
+
+def split_shares(amount, shares):
+    # amount in minor units, shares as {member: weight}: the cents lost by rounding down go to the
+    # members with the largest remainders, so the parts always add up to the amount
+    total_weight = sum(shares.values())
+    parts = dict()
+    remainders = list()
+    for member, weight in shares.items():
+        exact = amount * weight / total_weight
+        parts[member] = int(exact // 1)
+        remainders.append((exact - parts[member], member))
+    missing = amount - sum(parts.values())
+    for _, member in sorted(remainders, key=lambda item: item[0], reverse=True)[:missing]:
+        parts[member] += 1
+    return parts
+
+
+def settle(balances):
+    # balances in minor units: positive for who still has to give, negative for who has to receive.
+    # Returns (payer, payee, amount) transfers.
+    members = sorted((member, balance) for member, balance in balances.items() if balance != 0)
+    if len(members) <= EXACT_LIMIT:
+        groups = _zero_sum_groups(members)
+    else:
+        groups, members = _matching_pairs(members)
+        groups.append(members)
+    transfers = list()
+    for group in groups:
+        transfers.extend(_settle_group(group))
+    return transfers
+
+
+def _zero_sum_groups(members):
+    # n people need n - k transfers, where k is the largest number of disjoint groups whose balances
+    # add up to zero: find those groups with a dynamic programme over the subsets of people
+    count = len(members)
+    best = [0] * (1 << count)
+    sums = [0] * (1 << count)
+    for mask in range(1, 1 << count):
+        lowest = mask & -mask
+        sums[mask] = sums[mask ^ lowest] + members[lowest.bit_length() - 1][1]
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            best[mask] = max(best[mask], best[mask ^ bit])
+            rest ^= bit
+        if sums[mask] == 0:
+            best[mask] += 1
+    groups = list()
+    boundary = mask = (1 << count) - 1
+    while mask:
+        if mask != boundary and sums[mask] == 0:
+            groups.append(_members_of(members, boundary ^ mask))
+            boundary = mask
+        closing = 1 if sums[mask] == 0 else 0
+        rest = mask
+        while rest:
+            bit = rest & -rest
+            if best[mask ^ bit] + closing == best[mask]:
+                mask ^= bit
+                break
+            rest ^= bit
+    if boundary:
+        groups.append(_members_of(members, boundary))
+    return groups
+
+
+def _members_of(members, mask):
+    return [member for position, member in enumerate(members) if mask >> position & 1]
+
+
+def _matching_pairs(members):
+    # a debt equal to a credit is settled by a single transfer between the two
+    credits = dict()
+    for member, balance in members:
+        if balance < 0:
+            credits.setdefault(-balance, list()).append(member)
+    pairs = list()
+    paired = set()
+    for member, balance in members:
+        if balance > 0 and credits.get(balance):
+            creditor = credits[balance].pop()
+            pairs.append([(member, balance), (creditor, -balance)])
+            paired.update((member, creditor))
+    return pairs, [(member, balance) for member, balance in members if member not in paired]
+
+
+def _settle_group(group):
+    debtors = [(-balance, member) for member, balance in group if balance > 0]
+    creditors = [(balance, member) for member, balance in group if balance < 0]
+    heapq.heapify(debtors)
+    heapq.heapify(creditors)
+    transfers = list()
+    while debtors and creditors:
+        debt, payer = heapq.heappop(debtors)
+        credit, payee = heapq.heappop(creditors)
+        amount = min(-debt, -credit)
+        transfers.append((payer, payee, amount))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, payer))
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, payee))
+    return transfers
@@ -0,0 +1,53 @@
+import csv
+import re
+
+# Readers for uploaded bank statements: each one yields (line number, row) pairs while reading the
+# file, so a statement is never loaded in memory as a whole
+OFX_TAG = re.compile(r"<(/?\w+)>([^<\r\n]*)")
+
+
+def read_csv_rows(stream):
+    # fields beyond the header are kept as a list under None, as csv.DictReader does, for the row to be rejected
+    reader = csv.DictReader(stream)
+    for row in reader:
+        extra = row.pop(None, None)
+        fields = {(key or "").strip().lower(): (value or "").strip() for key, value in row.items()}
+        if extra:
+            fields[None] = extra
+        yield reader.line_num, fields
+
+
+def read_ofx_rows(stream):
+    # works for the SGML flavour of OFX, where closing tags are optional, as well as for the XML one
+    currency = ""
+    transaction = None
+    for line_number, line in enumerate(stream, start=1):
+        for tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            value = value.strip()
+            if tag in ("STMTTRN", "/STMTTRN", "/BANKTRANLIST") and transaction is not None:
+                yield _ofx_row(transaction, currency)
+                transaction = None
+            if tag == "CURDEF":
+                currency = value
+            elif tag == "STMTTRN":
+                transaction = {"line": line_number}
+            elif transaction is None:
+                continue
+            elif tag == "DTPOSTED":
+                transaction["date"] = f"{value[0:4]}-{value[4:6]}-{value[6:8]}"
+            elif tag == "TRNAMT":
+                transaction["amount"] = value
+            elif tag in ("NAME", "MEMO") and value:
+                transaction.setdefault("description", value)
+    if transaction is not None:
+        yield _ofx_row(transaction, currency)
+
+
+def _ofx_row(transaction, currency):
+    amount = transaction.get("amount", "")
+    # debits are negative in OFX: they are expenses, credits are income
+    kind = "expenses" if amount.startswith("-") else "income"
+    return transaction["line"], {"date": transaction.get("date", ""), "amount": amount.lstrip("-+"),
+                                 "currency": currency, "description": transaction.get("description", ""),
+                                 "kind": kind}
@@ -0,0 +1,44 @@
+import json
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Reading of the JSON files kept by older versions, only used by the import-json command.
+LOCK_SUFFIX = ".lock"
+
+
+@contextmanager
+def file_lock(filepath, exclusive=True):
+    # advisory lock shared by every process using the file; a no-op where fcntl is not available
+    with open(filepath + LOCK_SUFFIX, "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def stamp_generation(filepath):
+    # other processes notice the new mtime through read_generation
+    with open(filepath, "a"):
+        pass
+    os.utime(filepath)
+
+
+def read_generation(filepath):
+    return os.stat(filepath).st_mtime_ns if os.path.exists(filepath) else None
+
+
+def read_from_file(filepath):
+    data = dict()
+    with file_lock(filepath, exclusive=False):
+        if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
+            with open(filepath, "r") as file:
+                data = json.load(file)
+    return data
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# the app reads its configuration when it is imported: a database of its own, and cheap hashes computed inline.
+# Like the app, the tests run from the repository root, where exchange_rates.json is
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ["BCRYPT_LOG_ROUNDS"] = "4"
+os.environ["PASSWORD_HASH_WORKERS"] = "0"
+
+from app import app, db, User  # noqa: E402
+from rates import refresh_rates  # noqa: E402
+
+PASSWORD = "test-password"
+
+
+@pytest.fixture
+def database():
+    # every request pushes its own context, as in the app: the tests open one for what they call directly
+    app.config["WTF_CSRF_ENABLED"] = False
+    refresh_rates()
+    yield
+    with app.app_context():
+        for table in reversed(db.metadata.sorted_tables):
+            db.session.execute(table.delete())
+        db.session.commit()
+
+
+@pytest.fixture
+def client(database):
+    # logged in as the user of the user_id fixture
+    client = app.test_client()
+    client.post("/register", data={"username": "tester", "password": PASSWORD})
+    response = client.post("/login", data={"username": "tester", "password": PASSWORD})
+    assert response.status_code == 302
+    return client
+
+
+@pytest.fixture
+def user_id(client):
+    with app.app_context():
+        return User.query.filter_by(username="tester").one().id
@@ -0,0 +1,110 @@
+import io
+from datetime import date, timedelta
+
+import pytest
+
+from app import app, Expense, MonthlyTotal, SharedFriend, SharedGroup, rebuild_monthly_totals, \
+    rebuild_group_balances
+
+
+def months_ago(months, day=1):
+    today = date.today()
+    count = today.year * 12 + today.month - 1 - months
+    return date(count // 12, count % 12 + 1, day)
+
+
+def add_expense(client, amount, currency, day, category="food"):
+    response = client.post("/add_expense", data={"amount": amount, "currency": currency, "description": "test",
+                                                 "date": day.isoformat(), "category": category})
+    assert response.status_code == 302
+
+
+def stored_totals(user_id):
+    with app.app_context():
+        return [(total.year, total.month, total.total, total.count)
+                for total in MonthlyTotal.query.filter_by(user_id=user_id).order_by(MonthlyTotal.year,
+                                                                                    MonthlyTotal.month)]
+
+
+def assert_totals_rebuilt_alike(user_id):
+    # the totals kept up to date by every change are those computed again from the expenses
+    incremental = stored_totals(user_id)
+    with app.app_context():
+        rebuild_monthly_totals(user_id)
+    rebuilt = stored_totals(user_id)
+    assert [(year, month, count) for year, month, _, count in incremental] == \
+        [(year, month, count) for year, month, _, count in rebuilt]
+    assert [total for _, _, total, _ in incremental] == pytest.approx([total for _, _, total, _ in rebuilt])
+    return rebuilt
+
+
+def test_pages_keep_monthly_totals(client, user_id):
+    client.post("/add_category", data={"name": "food"})
+    client.post("/add_category", data={"name": "rent"})
+    add_expense(client, "12.50", "€", months_ago(2, 3))
+    # the first read builds the totals, every change from then on updates them
+    assert client.get("/dashboard").status_code == 200
+    add_expense(client, "30", "¥", months_ago(2, 20))
+    add_expense(client, "8", "$", months_ago(1, 5))
+    add_expense(client, "5", "£", months_ago(0, 1))
+    with app.app_context():
+        moved, deleted = [expense.id for expense in Expense.query.filter_by(user_id=user_id).order_by(Expense.id)][1:3]
+    response = client.post(f"/expenses/{moved}/edit", data={"amount": "40", "currency": "€", "description": "moved",
+                                                           "date": months_ago(3, 10).isoformat(),
+                                                           "category": "food"})
+    assert response.status_code == 302
+    client.post("/expenses", data={"delete": deleted})
+    statement = "date,amount,currency,description,category\n" \
+        f"{months_ago(1, 2)},20,EUR,imported,food\n" \
+        f"{months_ago(4, 2)},7.5,USD,imported,rent\n" \
+        f"{months_ago(1, 3)},abc,EUR,not imported,food\n"
+    response = client.post("/import", data={"kind": "expenses", "category": "",
+                                            "file": (io.BytesIO(statement.encode()), "statement.csv")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 200
+    response = client.post("/forecast", data={"kind": "expenses", "amount": "300", "currency": "€",
+                                              "description": "rent", "category": "rent",
+                                              "start_date": months_ago(5, 1).isoformat()})
+    assert response.status_code == 302
+    rebuilt = assert_totals_rebuilt_alike(user_id)
+    # six months of rent, four expenses left from the page and two imported rows
+    assert len(rebuilt) == 6
+    assert sum(count for _, _, _, count in rebuilt) == 11
+
+
+def test_deleting_every_expense_leaves_no_totals(client, user_id):
+    client.post("/add_category", data={"name": "food"})
+    add_expense(client, "10", "€", months_ago(1, 1))
+    client.get("/dashboard")
+    add_expense(client, "10", "€", months_ago(0, 1))
+    with app.app_context():
+        expense_ids = [expense.id for expense in Expense.query.filter_by(user_id=user_id)]
+    for expense_id in expense_ids:
+        client.post("/expenses", data={"delete": expense_id})
+    assert stored_totals(user_id) == []
+    assert assert_totals_rebuilt_alike(user_id) == []
+
+
+def test_group_balances_match_a_rebuild(client, user_id):
+    client.post("/add_category", data={"name": "food"})
+    client.get("/shared")
+    with app.app_context():
+        group_id = SharedGroup.query.filter_by(user_id=user_id).one().id
+    for name in ("Anna", "Bob", "Carl"):
+        client.post(f"/shared?group={group_id}", data={"friends": name})
+    day = date.today() - timedelta(days=3)
+    for amount, currency, paid_by, split in [("30", "€", "Anna", ""), ("10.01", "¥", "Bob", "Anna:2, Carl:1"),
+                                             ("7", "$", "Carl", "Bob:1"), ("99.99", "£", "Anna", "")]:
+        response = client.post(f"/shared?group={group_id}",
+                               data={"amount": amount, "currency": currency, "date": day.isoformat(),
+                                     "category": "food", "paid_by": paid_by, "split": split})
+        assert response.status_code == 302
+    with app.app_context():
+        incremental = [(friend.name, friend.paid, friend.owed)
+                       for friend in SharedFriend.query.filter_by(group_id=group_id).order_by(SharedFriend.id)]
+        rebuild_group_balances(group_id)
+        rebuilt = [(friend.name, friend.paid, friend.owed)
+                   for friend in SharedFriend.query.filter_by(group_id=group_id).order_by(SharedFriend.id)]
+    assert incremental == rebuilt
+    # in minor units, what was paid is exactly what is owed
+    assert sum(paid for _, paid, _ in rebuilt) == sum(owed for _, _, owed in rebuilt) > 0
@@ -0,0 +1,107 @@
+import json
+import threading
+from datetime import date, timedelta
+
+import pytest
+
+import rates
+from app import app, db, Expense, MonthlyPlan, RecurringRule, refresh_recurring, remove_recurring_rule, \
+    rule_occurrences
+
+
+def add_rule(user_id, start, amount=100, currency="€", category="rent", day=None, end_date=None):
+    with app.app_context():
+        rule = RecurringRule(user_id=user_id, kind="expenses", amount=amount, currency=currency, description="rent",
+                             category=category, day=day or start.day, end_date=end_date, next_date=start,
+                             planned_until=start)
+        db.session.add(rule)
+        db.session.commit()
+        return rule.id
+
+
+def plans(user_id):
+    with app.app_context():
+        return [(plan.year, plan.month, plan.amount)
+                for plan in MonthlyPlan.query.filter_by(user_id=user_id).order_by(MonthlyPlan.year, MonthlyPlan.month)]
+
+
+def refresh(user_id, today):
+    with app.app_context():
+        refresh_recurring(user_id, today)
+
+
+def saved_days(user_id):
+    with app.app_context():
+        return [expense.date for expense in Expense.query.filter_by(user_id=user_id).order_by(Expense.date)]
+
+
+def test_plan_covers_the_forecast_until_saved(user_id):
+    add_rule(user_id, date(2026, 1, 15), currency="¥", end_date=date(2026, 6, 30))
+    refresh(user_id, date(2026, 3, 20))
+    assert saved_days(user_id) == [date(2026, 1, 15), date(2026, 2, 15), date(2026, 3, 15)]
+    assert plans(user_id) == [(2026, 4, 100), (2026, 5, 100), (2026, 6, 100)]
+    # once every occurrence is saved, nothing is left planned
+    refresh(user_id, date(2026, 7, 1))
+    assert len(saved_days(user_id)) == 6
+    assert plans(user_id) == []
+
+
+def test_removed_rule_leaves_no_plan(user_id):
+    add_rule(user_id, date(2026, 1, 15))
+    add_rule(user_id, date(2026, 2, 1), category="food")
+    refresh(user_id, date(2026, 3, 20))
+    assert len(plans(user_id)) == 22
+    with app.app_context():
+        for rule in RecurringRule.query.filter_by(user_id=user_id).all():
+            remove_recurring_rule(rule)
+    assert plans(user_id) == []
+    # the transactions already saved are kept
+    assert len(saved_days(user_id)) == 5
+
+
+def test_new_rate_leaves_nothing_planned(user_id, tmp_path):
+    # planned at one rate and saved at another: the row planned is what goes away
+    rates_file = tmp_path / "rates.json"
+    rates_file.write_text(json.dumps({"base": "¥", "rates": {"€": {"2020-01-01": 7.0}}}))
+    rates.refresh_rates(str(rates_file))
+    add_rule(user_id, date(2026, 11, 5))
+    add_rule(user_id, date(2026, 11, 20))
+    refresh(user_id, date(2026, 10, 18))
+    assert plans(user_id)[:2] == [(2026, 11, 700), (2026, 11, 700)]
+    rates_file.write_text(json.dumps({"base": "¥", "rates": {"€": {"2020-01-01": 8.0}}}))
+    rates.refresh_rates(str(rates_file))
+    refresh(user_id, date(2026, 11, 10))
+    assert [plan for plan in plans(user_id) if plan[:2] == (2026, 11)] == [(2026, 11, 700)]
+    refresh(user_id, date(2026, 11, 30))
+    assert [plan for plan in plans(user_id) if plan[:2] == (2026, 11)] == []
+
+
+@pytest.mark.parametrize("start, expected", [
+    (date(2026, 1, 31), [date(2026, 1, 31), date(2026, 2, 28), date(2026, 3, 31), date(2026, 4, 30)]),
+    (date(2027, 12, 31), [date(2027, 12, 31), date(2028, 1, 31), date(2028, 2, 29), date(2028, 3, 31)]),
+])
+def test_day_31_is_clamped_to_short_months(user_id, start, expected):
+    rule_id = add_rule(user_id, start)
+    with app.app_context():
+        rule = db.session.get(RecurringRule, rule_id)
+        assert list(rule_occurrences(rule, start, expected[-1] + timedelta(days=1))) == expected
+    refresh(user_id, expected[-1])
+    assert saved_days(user_id) == expected
+
+
+def test_concurrent_refreshes_save_each_occurrence_once(user_id):
+    add_rule(user_id, date(2026, 1, 1), currency="¥")
+    barrier = threading.Barrier(2)
+
+    def run():
+        with app.app_context():
+            barrier.wait()
+            refresh_recurring(user_id, date(2026, 10, 18))
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(saved_days(user_id)) == 10
+    assert [amount for _, _, amount in plans(user_id)] == [100] * 11
@@ -0,0 +1,65 @@
+import random
+from itertools import combinations
+
+from settlements import EXACT_LIMIT, settle, split_shares
+
+
+def fewest_transfers(balances):
+    # by brute force: n people need n - k transfers, k being the most disjoint groups adding up to zero
+    def most_groups(members):
+        if not members:
+            return 0
+        first, rest = members[0], members[1:]
+        best = 0
+        for size in range(len(rest) + 1):
+            for others in combinations(rest, size):
+                if first[1] + sum(balance for _, balance in others) == 0:
+                    left = [member for member in rest if member not in others]
+                    best = max(best, 1 + most_groups(left))
+        return best
+
+    members = [(member, balance) for member, balance in balances.items() if balance != 0]
+    return len(members) - most_groups(members)
+
+
+def random_balances(generator, count):
+    balances = {f"friend {i}": generator.choice([-300, -150, -100, -50, 50, 100, 150, 300])
+                for i in range(count - 1)}
+    balances[f"friend {count - 1}"] = -sum(balances.values())
+    return balances
+
+
+def assert_settles(balances, transfers):
+    remaining = dict(balances)
+    for payer, payee, amount in transfers:
+        assert amount > 0
+        remaining[payer] -= amount
+        remaining[payee] += amount
+    assert all(balance == 0 for balance in remaining.values())
+
+
+def test_settle_uses_the_fewest_transfers():
+    generator = random.Random(0)
+    for _ in range(200):
+        balances = random_balances(generator, generator.randint(1, 8))
+        transfers = settle(balances)
+        assert_settles(balances, transfers)
+        assert len(transfers) == fewest_transfers(balances)
+
+
+def test_settle_large_group():
+    generator = random.Random(1)
+    balances = random_balances(generator, EXACT_LIMIT * 3)
+    transfers = settle(balances)
+    assert_settles(balances, transfers)
+    assert len(transfers) < len([balance for balance in balances.values() if balance])
+
+
+def test_split_shares_adds_up():
+    generator = random.Random(2)
+    for _ in range(200):
+        amount = generator.randint(0, 100000)
+        shares = {f"friend {i}": generator.randint(1, 5) for i in range(generator.randint(1, 7))}
+        parts = split_shares(amount, shares)
+        assert sum(parts.values()) == amount
+        assert all(part >= 0 for part in parts.values())